@@ -0,0 +1,49 @@
+"""Compare the throughput of the age parser with the legacy parser.
+
+Usage: python benchmarks/bench_age_parser.py [count]
+"""
+import os
+import sys
+import time
+
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, project_dir)
+sys.path.insert(0, os.path.join(project_dir, 'tests'))
+import legacy_age_parser
+from src.data import age_parser
+from test_age_parser import make_ages
+
+REPEATS = 5 # timed runs, of which the fastest is reported
+
+
+def measure(parse, values):
+    """Return the values parsed per second by the fastest run."""
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        parse(values)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(values) / best
+
+
+def main(count):
+    # Survey answers repeat, so the distinct ages are a fraction of the rows.
+    distinct = make_ages(count // 10)
+    values = distinct * 10
+    cases = [
+        ('legacy', lambda values: [legacy_age_parser.parse_contents(value, 'y')
+                                   for value in values]),
+        ('parse', lambda values: [age_parser.parse(value, 'y')
+                                  for value in values]),
+        ('parse_many', lambda values: age_parser.parse_many(values, 'y'))
+        ]
+    baseline = None
+    for name, parse in cases:
+        rate = measure(parse, values)
+        baseline = baseline or rate
+        print('%-10s %12.0f values/s %6.2fx' %(name, rate, rate / baseline))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
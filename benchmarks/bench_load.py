@@ -0,0 +1,112 @@
+"""Compare the rows per second of the per-row and the bulk table loads.
+
+Usage: python benchmarks/bench_load.py [dogs ...]
+"""
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, project_dir)
+sys.path.insert(0, os.path.join(project_dir, 'tests'))
+from conftest import ExportGenerator
+from src.data import make_dataset
+
+TABLES = ('users', 'feedback', 'dogs')
+SIZES = [10000, 100000, 1000000] # dogs loaded, by default
+BASE_ROWS = 5000 # raw rows generated, then repeated up to each size
+REPEATS = 3 # timed runs, of which the fastest is reported
+SINGLE_RUN_SIZE = 1000000 # dogs from which a single run is timed
+
+
+def read_tables(path):
+    """Return the schema and the records of the loaded tables."""
+    conn = sqlite3.connect(path)
+    try:
+        tables = {}
+        for table in TABLES:
+            sql = conn.execute('SELECT sql FROM sqlite_master WHERE name=?;',
+                               (table,)).fetchone()[0]
+            tables[table] = (sql, conn.execute('SELECT * FROM %s;'
+                                               %table).fetchall())
+        return tables
+    finally:
+        conn.close()
+
+
+def scale_tables(tables, dogs):
+    """Return the tables repeated up to a number of dogs."""
+    scale = dogs / len(tables['dogs'][1])
+    scaled = {}
+    for table, (sql, records) in tables.items():
+        count = round(len(records) * scale)
+        # The records are shared, so that large sizes fit in memory.
+        repeated = records * (count // len(records) + 1)
+        scaled[table] = (sql, repeated[:count])
+    return scaled
+
+
+def load_rows(db, tables):
+    """Insert every record with its own statement, as the tables once were."""
+    for table, (_, records) in tables.items():
+        for record in records:
+            db.insert_record(table, record)
+    db.commit()
+
+
+def load_bulk(db, tables):
+    """Insert the records in executemany batches, as populate_tables does."""
+    db.configure_for_load()
+    db.begin()
+    for table, (_, records) in tables.items():
+        for chunk in make_dataset.chunked(records,
+                                          make_dataset.BULK_BATCH_SIZE):
+            db.insert_records(table, chunk)
+    db.commit()
+
+
+def measure(load, tables, directory, repeats):
+    """Return the seconds of the fastest load into a new database."""
+    best = None
+    for i in range(repeats):
+        path = os.path.join(directory, '%s_%d.db' %(load.__name__, i))
+        db = make_dataset.Database(path)
+        for sql, _ in tables.values():
+            db.get_connection().execute(sql)
+        start = time.perf_counter()
+        load(db, tables)
+        elapsed = time.perf_counter() - start
+        db.close()
+        os.remove(path)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(sizes):
+    export = ExportGenerator()
+    rows = [export.header] + export.make_rows(BASE_ROWS, BASE_ROWS // 2)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'processed.db')
+        manager = make_dataset.Manager(rows, path=path)
+        manager.create_tables()
+        manager.populate_tables()
+        del manager
+        base = read_tables(path)
+        print('%10s %10s %10s %12s %10s %12s %8s'
+              %('dogs', 'records', 'per-row s', 'rows/s', 'bulk s',
+                'rows/s', 'speedup'))
+        for dogs in sizes:
+            tables = scale_tables(base, dogs)
+            records = sum(len(records) for _, records in tables.values())
+            repeats = REPEATS if dogs < SINGLE_RUN_SIZE else 1
+            per_row = measure(load_rows, tables, directory, repeats)
+            bulk = measure(load_bulk, tables, directory, repeats)
+            print('%10d %10d %10.3f %12.0f %10.3f %12.0f %7.2fx'
+                  %(dogs, records, per_row, records / per_row, bulk,
+                    records / bulk, per_row / bulk))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or SIZES)
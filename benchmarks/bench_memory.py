@@ -0,0 +1,135 @@
+"""Compare the memory of the compact entries with the former entries.
+
+The former entries kept list copies of the raw rows in ordinary objects;
+the current ones keep shared tuples in __slots__.
+
+Usage: python benchmarks/bench_memory.py [rows]
+"""
+import csv
+import gc
+import os
+import sqlite3
+import sys
+import tempfile
+import tracemalloc
+
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, project_dir)
+sys.path.insert(0, os.path.join(project_dir, 'tests'))
+from conftest import ExportGenerator
+from src.data import age_parser
+from src.data import make_dataset
+
+
+class LegacyDogEntry(object):
+
+    def __init__(self, uid, data, ages, schema):
+        """Initialize a LegacyDogEntry object."""
+        self.__name = data[0]
+        # The dog data was cleaned in place in a list of the raw values.
+        self.__data = list(make_dataset.DogEntry(uid, tuple(data), ages,
+                                                 schema).get_data())
+
+    def get_name(self):
+        """Return the dog name."""
+        return self.__name
+
+
+class LegacyUserEntry(object):
+
+    def __init__(self, uid, data, ages, schemas):
+        """Initialize a LegacyUserEntry object."""
+        self.__uid = uid
+        self.__ages = ages
+        self.__schemas = schemas
+        self.__user_info = data[make_dataset.USER_INFO_COLUMNS]
+        self.__feedback = data[make_dataset.FEEDBACK_COLUMNS]
+        self.__dogs = []
+        self.__update_dogs(data)
+
+    def __update_dogs(self, data):
+        """Update dog data for the user."""
+        for start, end in make_dataset.DOG_BLOCKS:
+            if data[end-1] != '2':
+                continue
+            dog = LegacyDogEntry(self.__uid, data[start:end], self.__ages,
+                                 self.__schemas['dogs'])
+            for counter, other in enumerate(self.__dogs):
+                if other.get_name().lower() == data[start].lower():
+                    self.__dogs[counter] = dog
+                    break
+            else:
+                self.__dogs.append(dog)
+
+    def update(self, data):
+        """Update the user with new entry data."""
+        self.__update_dogs(data)
+        if data[make_dataset.USER_STATUS_COLUMN] == '2':
+            self.__user_info = data[make_dataset.USER_INFO_COLUMNS]
+        if data[make_dataset.FEEDBACK_STATUS_COLUMN] == '2':
+            self.__feedback = data[make_dataset.FEEDBACK_COLUMNS]
+
+
+class LegacyDatastore(object):
+
+    def __init__(self, ages, schemas):
+        """Initialize a LegacyDatastore object."""
+        self.__users = {}
+        self.__ages = ages
+        self.__schemas = schemas
+        self.__uid = 0
+
+    def add_entry(self, data):
+        """Add an entry to the user database."""
+        if make_dataset.is_valid_entry(data):
+            user = data[make_dataset.USER_COLUMN]
+            if user in self.__users:
+                self.__users[user].update(data)
+            else:
+                self.__uid += 1
+                self.__users[user] = LegacyUserEntry(self.__uid, data,
+                                                     self.__ages,
+                                                     self.__schemas)
+
+
+def measure(make_store, path, schemas):
+    """Return the retained and peak bytes of loading a raw file."""
+    ages = age_parser.AgeCache(sqlite3.connect(':memory:'))
+    gc.collect()
+    tracemalloc.start()
+    with open(path, newline='') as fin:
+        reader = csv.reader(fin)
+        next(reader)
+        store = make_store(ages, schemas)
+        for row in reader:
+            store.add_entry(row)
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retained, peak
+
+
+def main(count):
+    export = ExportGenerator()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'raw.csv')
+        with open(path, 'w', newline='') as fout:
+            writer = csv.writer(fout)
+            writer.writerow(export.header)
+            writer.writerows(export.make_rows(count, count // 2))
+        print('%d raw rows' %count)
+        schemas = make_dataset.Manager(
+            [export.header],
+            path=os.path.join(directory, 'schemas.db')).get_schemas()
+        baseline = None
+        for name, make_store in [('legacy', LegacyDatastore),
+                                 ('slots', make_dataset.Datastore)]:
+            retained, peak = measure(make_store, path, schemas)
+            baseline = baseline or retained
+            print('%-8s retained %8.1f MB  peak %8.1f MB %6.2fx'
+                  %(name, retained / 2**20, peak / 2**20,
+                    retained / baseline))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -18,6 +18,9 @@ import math
 import sys
 sys.path.append("..")
 from src.utilities import field_registry as fieldreg
+from src.utilities import data_dictionary as datadict
+from src.utilities import parquet_tables
+from src.utilities import profiling
 
 # Data Globals
 FR = fieldreg.FieldRegistry()
@@ -32,32 +35,50 @@ NITER = 10000
 # Database Globals
 USER_TABLE = 'users'
 DOG_TABLE = 'dogs'
-BIAS_FILTER = '''
-    USING (record_id)
-    WHERE question_reason_for_part_3 = 0
-    OR (question_reason_for_part_3 = 1 AND q01_main != 1)'''
-CON = sqlite3.connect('../data/processed/processed.db')
+# Bias-filtered dogs joined to their users, materialized by make_dataset.
+ADJUSTED_TABLE = 'dogs_adjusted'
+PROCESSED_DIR = '../data/processed'
+DATABASE_PATH = os.path.join(PROCESSED_DIR, 'processed.db')
+CON = sqlite3.connect(DATABASE_PATH)
+DICTIONARY = datadict.DataDictionary('../docs/data_dictionary.csv')
+SQL_TYPES = {}
+for table in (USER_TABLE, DOG_TABLE):
+    SQL_TYPES.update(datadict.get_declared_types(CON, table))
 
 
 # Helper Functions
-def createStringDataFrame(table, fields, labels, filtered=True):
-    query = 'SELECT ' + fields + ' FROM ' + table
+def queryDataFrame(table, fields, filtered=True):
     if filtered:
-        table2 = USER_TABLE if table == DOG_TABLE else DOG_TABLE
-        query += ' JOIN ' + table2 + ' ' + BIAS_FILTER
-    df = pd.read_sql_query(query, CON)
+        table = ADJUSTED_TABLE
+    # Plain column lists are read from the Parquet export when it is current.
+    df = parquet_tables.read_table(PROCESSED_DIR, table, fields, DATABASE_PATH)
+    if df is not None:
+        return df
+    query = 'SELECT ' + fields + ' FROM ' + table
+    return pd.read_sql_query(query, CON)
+
+
+def createStringDataFrame(table, fields, labels, filtered=True):
+    df = queryDataFrame(table, fields, filtered)
     df.columns = labels
     return df
 
 
-def convertToNumeric(df):
-    df = df.apply(pd.to_numeric, errors='coerce')
+def compactDataFrame(df):
+    # Columns are typed in the database, so only narrow the dtypes.
+    for col in df.columns:
+        if col in SQL_TYPES:
+            df[col] = datadict.compact_series(df[col], SQL_TYPES[col],
+                                              DICTIONARY.get_field_type(col))
+        elif df[col].dtype == object:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
     return df
 
 
 def createNumericDataFrame(table, fields, labels, filtered=True):
-    df = createStringDataFrame(table, fields, labels, filtered)
-    return convertToNumeric(df)
+    df = compactDataFrame(queryDataFrame(table, fields, filtered))
+    df.columns = labels
+    return df
 
 
 def replaceFields(df, column, replacement_dict):
@@ -285,8 +306,8 @@ def impact_of_gender_on_house_soiling_w_fear_anxiety():
     fields = 'dog_sex, q02_main_4, q02_main_2' 
     labels = ['sex', 'house soiling', 'fear/anxiety']
     df = createStringDataFrame(DOG_TABLE, fields, labels)
-    df = df[df[labels[0]] != '']
-    df = df[df[labels[2]] == '1']
+    df = df[df[labels[0]].notnull()]
+    df = df[df[labels[2]] == 1]
     df.drop(columns=labels[2], inplace=True)
     df = df.apply(pd.to_numeric)
 
@@ -681,7 +702,7 @@ def impact_of_gender_on_biting():
     fields = 'dog_sex, q03_form_5'
     labels = ['sex', 'bites']
     df = createStringDataFrame(DOG_TABLE, fields, labels)
-    df = df[df[labels[0]] != '']
+    df = df[df[labels[0]].notnull()]
     df = df.apply(pd.to_numeric)
 
     def gender_to_binary_response(x):
@@ -723,7 +744,7 @@ def impact_of_neuter_status_on_biting():
     fields = 'dog_spayed, q03_form_5'
     labels = ['neutered', 'bites']
     df = createStringDataFrame(DOG_TABLE, fields, labels)
-    df = df[df[labels[0]] != '']
+    df = df[df[labels[0]].notnull()]
     df = df.apply(pd.to_numeric)
 
     def gender_to_binary_response(x):
@@ -793,21 +814,27 @@ def impact_of_fear_anxiety_biting():
 
 
 def main():
-    number_of_participants()
-    number_of_participating_dogs()
-    adjusted_sample()
-    impact_of_gender_on_house_soiling_w_fear_anxiety()
-    #prevalence_of_biting()
-    #bite_people()
-    #bite_dogs()
-    #multiple_bites_per_incident()
-    #bite_severity()
-    #bite_severity_by_behavior_problem()
-    #bite_severity_fear_anxiety()
-    #bite_prevalence_sex_and_neuter_status()
-    impact_of_gender_on_biting()
-    impact_of_neuter_status_on_biting()
-    impact_of_fear_anxiety_biting()
+    sections = [
+        number_of_participants,
+        number_of_participating_dogs,
+        adjusted_sample,
+        impact_of_gender_on_house_soiling_w_fear_anxiety,
+        #prevalence_of_biting,
+        #bite_people,
+        #bite_dogs,
+        #multiple_bites_per_incident,
+        #bite_severity,
+        #bite_severity_by_behavior_problem,
+        #bite_severity_fear_anxiety,
+        #bite_prevalence_sex_and_neuter_status,
+        impact_of_gender_on_biting,
+        impact_of_neuter_status_on_biting,
+        impact_of_fear_anxiety_biting
+        ]
+    # Each section is profiled apart when PDBS_PROFILE is set.
+    for section in sections:
+        with profiling.stage(section.__name__):
+            section()
 
 
 if __name__ == "__main__":
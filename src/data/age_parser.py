@@ -0,0 +1,245 @@
+import collections
+import hashlib
+import inspect
+import re
+
+# Parsed ages kept in memory by an AgeCache.
+CACHE_SIZE = 10000
+# Ages significantly older than the world record are rejected.
+MAX_MONTHS = 384
+# Replacements, applied in this order.
+WORDS = [
+    ('half', '.5'), ('one', '1'), ('two', '2'), ('three', '3'), ('four', '4'),
+    ('five', '5'), ('six', '6'), ('seven', '7'), ('eight', '8'),
+    ('nine', '9'), ('ten', '10'), ('eleven', '11'), ('twelve', '12')
+    ]
+FRACTIONS = [
+    ('1/2', '.5'), ('1/12', '.083'), ('1/3', '.33'), ('1/4', '.25'),
+    ('3/4', '.75'), ('1/5', '.2')
+    ]
+# Operators of ranges and sums, each with its compiled pattern. The '+' is
+# left unescaped, so it repeats the first number instead of matching a plus.
+NUMBER = '([0-9\\.]+)'
+RANGES = [(oper, re.compile(NUMBER + pattern + NUMBER))
+          for oper, pattern in [('-', '-'), ('or', 'or'), ('to', 'to'),
+                                ('..', '\\.\\.')]]
+SUMS = [(oper, re.compile(NUMBER + oper + NUMBER))
+        for oper in ['+', 'anda', 'and', '&']]
+DIGIT = re.compile('\\d')
+WEEKS = re.compile('([0-9\\.]+)(weeks)+')
+MONTHS = re.compile('([0-9\\.]+)(months|mon)+')
+YEARS = re.compile('([0-9\\.]+).?([y,e,a,r,s]{3}|y)+')
+DECIMAL = re.compile('([0-9]+\\.[0-9]+|[0-9]+)')
+
+
+def parse(line, unit):
+    """Return a free-text age in months, or an empty string if invalid."""
+    return parse_with_reason(line, unit)[0]
+
+
+def parse_with_reason(line, unit):
+    """Return the parsed age and, if it is invalid, the reason why."""
+    try:
+        return '%.2f' %to_months(line, unit), None
+    except ValueError as err:
+        # The reason precedes the offending value in the message.
+        return '', str(err).split(':')[0]
+
+
+def parse_many(values, unit):
+    """Return the ages of a sequence, parsing each distinct value once."""
+    parsed = {}
+    ages = []
+    for value in values:
+        age = parsed.get(value)
+        if age is None:
+            age = parsed[value] = parse(value, unit)
+        ages.append(age)
+    return ages
+
+
+def to_months(line, unit):
+    """Convert a free-text age in the given unit ('m' or 'y') to months."""
+    original = line
+    scale = 12 if unit == 'y' else 1
+    # Make lowercase and remove whitespace.
+    line = line.lower().replace(' ', '')
+    for word, digits in WORDS:
+        if word in line:
+            line = line.replace(word, digits)
+    # Return no result when no digits in input.
+    if not DIGIT.search(line):
+        raise ValueError('No digits: %s' %original)
+    # First check for purely digit strings.
+    try:
+        months = float(line) * scale
+    except ValueError:
+        months = 0
+    if months > 0:
+        return check_months(months, original, unit)
+    # Convert fractions to decimals.
+    for fraction, decimal in FRACTIONS:
+        if fraction in line:
+            line = line.replace(fraction, decimal)
+    if '/' in line:
+        raise ValueError('Invalid fractions: %s' %original)
+    # Convert ranges to averages.
+    for oper, pattern in RANGES:
+        if oper in line:
+            m = pattern.search(line)
+            if m:
+                lhs = float(m.group(1))
+                rhs = float(m.group(2))
+                # A lower rhs means the rhs is additive.
+                if lhs > rhs:
+                    avg = lhs + rhs
+                else:
+                    avg = (lhs + rhs) / 2
+                line = pattern.sub(str(avg), line)
+    # Parse out weeks, months, and years.
+    months = 0
+    for pattern, factor in [(WEEKS, 0.25), (MONTHS, 1), (YEARS, 12)]:
+        m = pattern.search(line)
+        if m:
+            months += float(m.group(1)) * factor
+            line = pattern.sub('', line)
+    # Perform addition when applicable.
+    for oper, pattern in SUMS:
+        if oper in line:
+            m = pattern.search(line)
+            if m:
+                total = float(m.group(1)) + float(m.group(2))
+                line = pattern.sub(str(total), line)
+    # Account for european use of comma.
+    line = line.replace(',', '.')
+    # Parse out a single remaining number.
+    numbers = DECIMAL.findall(line)
+    if len(numbers) == 1:
+        months += float(numbers[0]) * scale
+        line = DECIMAL.sub('', line)
+    # If digits remain, the input is invalid.
+    if DIGIT.search(line):
+        raise ValueError('Extra digits: %s' %original)
+    if months == 0:
+        raise ValueError('No parsed value: %s' %original)
+    return check_months(months, original, unit)
+
+
+def check_months(months, original, unit):
+    """Return the months unless they exceed the maximum age."""
+    if months > MAX_MONTHS:
+        raise ValueError('Extreme outlier: %s %s' %(original, unit))
+    return months
+
+
+def get_version():
+    """Return a hash of the parsing rules, which the cached ages carry."""
+    rules = [MAX_MONTHS, WORDS, FRACTIONS,
+             [pattern.pattern for _, pattern in RANGES + SUMS],
+             [pattern.pattern
+              for pattern in (DIGIT, WEEKS, MONTHS, YEARS, DECIMAL)],
+             inspect.getsource(to_months), inspect.getsource(check_months)]
+    return hashlib.sha1(repr(rules).encode('utf-8')).hexdigest()[:16]
+
+
+VERSION = get_version()
+
+
+class AgeCache(object):
+
+    def __init__(self, conn, size=CACHE_SIZE, version=VERSION):
+        """Initialize an AgeCache object."""
+        self.__conn = conn
+        self.__size = size # entries kept in memory
+        self.__version = version # parsing rules of the ages stored
+        self.__ages = collections.OrderedDict()
+        self.__pending = [] # parsed ages not yet stored
+        self.__counts = {'memory_hits': 0, 'table_hits': 0, 'misses': 0}
+        self.__failures = collections.Counter() # invalid ages by reason
+        columns = [row[1] for row in self.__conn.execute(
+            'PRAGMA table_info(age_cache);')]
+        if columns and 'version' not in columns:
+            # Ages cached before the rules were versioned.
+            self.__conn.execute('DROP TABLE age_cache;')
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS age_cache '
+                            '(value TEXT, unit TEXT, months TEXT, '
+                            'version TEXT, PRIMARY KEY (value, unit));')
+        # Ages parsed by other rules are parsed again.
+        self.__conn.execute('DELETE FROM age_cache WHERE version IS NOT ?;',
+                            (self.__version,))
+        self.__conn.commit()
+
+    def parse(self, value, unit):
+        """Return the parsed age, parsing only values not seen before."""
+        months, reason = self.__get((value, unit))
+        if reason:
+            self.__failures[reason] += 1
+        return months
+
+    def __get(self, key):
+        """Return the parsed age and failure reason of a value and unit."""
+        entry = self.__ages.get(key)
+        if entry is not None:
+            self.__ages.move_to_end(key)
+            self.__counts['memory_hits'] += 1
+        else:
+            entry = self.__load(key)
+            self.__ages[key] = entry
+            if len(self.__ages) > self.__size:
+                self.__ages.popitem(last=False)
+        return entry
+
+    def __load(self, key):
+        """Return the parsed age and failure reason of an uncached value."""
+        row = self.__conn.execute('SELECT months FROM age_cache '
+                                  'WHERE value=? AND unit=? AND version=?;',
+                                  key + (self.__version,)).fetchone()
+        if row and row[0]:
+            self.__counts['table_hits'] += 1
+            return row[0], None
+        if row:
+            # Only the reasons of invalid ages are parsed again.
+            self.__counts['table_hits'] += 1
+            return parse_with_reason(*key)
+        self.__counts['misses'] += 1
+        entry = parse_with_reason(*key)
+        self.__pending.append(key + (entry[0], self.__version))
+        return entry
+
+    def parse_many(self, values, unit):
+        """Return the parsed ages of a sequence, looking each value up once."""
+        parsed = {}
+        for value, count in collections.Counter(values).items():
+            months, reason = self.__get((value, unit))
+            parsed[value] = months
+            # The repeats count as if they were looked up one by one.
+            self.__counts['memory_hits'] += count - 1
+            if reason:
+                self.__failures[reason] += count
+        return [parsed[value] for value in values]
+
+    def flush(self):
+        """Store the newly parsed ages in the open transaction."""
+        self.__conn.executemany('INSERT OR IGNORE INTO age_cache '
+                                'VALUES (?, ?, ?, ?);', self.__pending)
+        self.__pending = []
+
+    def merge(self, schema):
+        """Store the ages cached in an attached database."""
+        self.__conn.execute('INSERT OR IGNORE INTO age_cache '
+                            'SELECT * FROM %s.age_cache WHERE version=?;'
+                            %schema, (self.__version,))
+
+    def add_counts(self, counts, failures):
+        """Add the counters of another cache to the counters."""
+        for key, value in counts.items():
+            self.__counts[key] += value
+        self.__failures.update(failures)
+
+    def get_counts(self):
+        """Return the cache hit and miss counters."""
+        return dict(self.__counts)
+
+    def get_failures(self):
+        """Return the counts of invalid ages by reason."""
+        return dict(self.__failures)
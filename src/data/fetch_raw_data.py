@@ -1,51 +1,452 @@
 from dotenv import find_dotenv, load_dotenv
 from requests import post
+import argparse
 import csv
+import datetime
+import email.utils
 import hashlib
+import hmac
+import io
+import json
 import logging
 import os
 import re
+import sys
+import zoneinfo
 
+# Imports from neighbor directories.
+sys.path.append(os.path.join(os.path.dirname(__file__), os.pardir, os.pardir))
+from src.utilities import data_dictionary as datadict
+from src.utilities import profiling
 
-def main():
-    """Fetching the raw data from REDCap."""
-    logger = logging.getLogger(__name__)
+WATERMARK_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Subtracted from the watermark so that records saved while the clocks drift
+# or an export is being written are fetched again by the next sync.
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+DELTA_FILENAME = 'delta.csv'
+SCRUB_BATCH_SIZE = 1000
+# Email to pseudonym map written by earlier versions, which must not be kept
+# beside the scrubbed export.
+LEGACY_MAP = 'pseudonyms.db'
 
-    logger.info('fetching raw data from database')
-    database_url = os.environ.get("DATABASE_URL")
-    api_token = os.environ.get("API_TOKEN")
+
+def export_records(database_url, api_token, stream=False, **params):
+    """Post a record export request to REDCap and return the response."""
     payload = {
         'token': api_token,
         'format': 'csv',
         'content': 'record'
         }
-    response = post(database_url, data=payload)
-    data = response.text.splitlines()
+    payload.update(params)
+    response = post(database_url, data=payload, stream=stream)
+    response.raise_for_status()
+    return response
 
-    logger.info('hashing emails and saving data')
-    hashes = {}
-    m = hashlib.md5()
-    pattern = r'.*@.*\.[a-z]*'
-    outfile = os.path.join(project_dir, 'data', 'raw', 'raw.csv')
-    with open(outfile, 'w') as fout:
+
+def stream_text(response):
+    """Return a text stream over a streamed response body."""
+    # Let the csv module see the raw line endings so that quoted newlines
+    # survive chunk boundaries.
+    response.raw.decode_content = True
+    response.raw.auto_close = False
+    return io.TextIOWrapper(response.raw, encoding=response.encoding or 'utf-8',
+                            newline='')
+
+
+def fetch_record_ids(database_url, api_token):
+    """Return the unique record IDs of the project in export order."""
+    response = export_records(database_url, api_token,
+                              **{'fields[0]': 'record_id'})
+    reader = csv.reader(response.text.splitlines())
+    next(reader, None) # header
+    record_ids = []
+    seen = set()
+    for row in reader:
+        if row and row[0] not in seen:
+            seen.add(row[0])
+            record_ids.append(row[0])
+    return record_ids
+
+
+def get_email_fields(path):
+    """Return the data dictionary fields validated as email addresses."""
+    return datadict.DataDictionary(path).get_email_fields()
+
+
+def fetch_metadata(database_url, api_token, path):
+    """Replace the data dictionary with the project metadata from REDCap."""
+    response = export_records(database_url, api_token, content='metadata')
+    # The compiled dictionary is rebuilt once the content hash changes.
+    temp_path = path + '.part'
+    with open(temp_path, 'wb') as fout:
+        fout.write(response.content)
+    os.replace(temp_path, path)
+
+
+def hash_emails(key, emails):
+    """Return the keyed pseudonyms for the provided emails."""
+    return [hmac.new(key, email.encode('utf-8'), hashlib.sha256).hexdigest()
+            for email in emails]
+
+
+class Pseudonymizer(object):
+
+    def __init__(self, key, email_fields):
+        """Initialize a Pseudonymizer object."""
+        if not key:
+            raise ValueError('PSEUDONYM_KEY must be set to hash emails.')
+        self.__key = key.encode('utf-8')
+        self.__email_fields = email_fields
+        self.__columns = None
+        # Pseudonyms of this run only; the keyed hash makes them stable, so
+        # no email is ever stored.
+        self.__pseudonyms = {}
+
+    def set_header(self, header):
+        """Locate the email columns of the export from its header."""
+        self.__columns = [index for index, name in enumerate(header)
+                          if re.sub('_1[a-e]', '', name) in self.__email_fields]
+        if not self.__columns:
+            logging.getLogger(__name__).warning(
+                'no email fields found in the export header, '
+                'scanning every column')
+
+    def __find_emails(self, row):
+        """Return the indexes of the row cells holding an email."""
+        if self.__columns:
+            return [index for index in self.__columns if row[index] != '']
+        pattern = r'.*@.*\.[a-z]*'
+        return [index for index, col in enumerate(row)
+                if col != '' and re.match(pattern, col)]
+
+    def scrub(self, rows):
+        """Replace the emails in a batch of rows with their pseudonyms."""
+        for row in rows:
+            for index in self.__find_emails(row):
+                email = row[index]
+                pseudonym = self.__pseudonyms.get(email)
+                if pseudonym is None:
+                    pseudonym = self.__pseudonyms[email] = hash_emails(
+                        self.__key, [email])[0]
+                row[index] = pseudonym
+        return rows
+
+
+def remove_legacy_map(raw_dir):
+    """Delete the cleartext email map written by earlier versions."""
+    path = os.path.join(raw_dir, LEGACY_MAP)
+    if os.path.isfile(path):
+        logging.getLogger(__name__).warning(
+            'removing %s, which maps emails to pseudonyms in clear text', path)
+        os.remove(path)
+
+
+def scrub_rows(reader, pseudonymizer):
+    """Yield phase 1 rows with the emails replaced by their pseudonyms."""
+    batch = []
+    for row in reader:
+        if row[1] == 'event_2_arm_1':
+            continue
+        batch.append(row)
+        if len(batch) == SCRUB_BATCH_SIZE:
+            yield from pseudonymizer.scrub(batch)
+            batch = []
+    if batch:
+        yield from pseudonymizer.scrub(batch)
+
+
+def stream_records(database_url, api_token, pseudonymizer, batch_size=None):
+    """Yield the export header, then the scrubbed rows as they arrive."""
+    if batch_size:
+        record_ids = fetch_record_ids(database_url, api_token)
+        batches = [record_ids[i:i+batch_size]
+                   for i in range(0, len(record_ids), batch_size)]
+    else:
+        batches = [None]
+    header_sent = False
+    for batch in batches:
+        params = {}
+        if batch is not None:
+            params = {'records[%d]' %i: record_id
+                      for i, record_id in enumerate(batch)}
+        response = export_records(database_url, api_token, stream=True,
+                                  **params)
+        reader = csv.reader(stream_text(response))
+        header = next(reader, None)
+        if header is None:
+            continue
+        if not header_sent:
+            yield header
+            header_sent = True
+        pseudonymizer.set_header(header)
+        yield from scrub_rows(reader, pseudonymizer)
+
+
+class BatchProgress(object):
+
+    def __init__(self, path):
+        """Initialize a BatchProgress object."""
+        self.__path = path
+        self.__state = {}
+
+    def load(self, batch_size):
+        """Return the saved state if it belongs to a run of this batch size."""
+        if not os.path.isfile(self.__path):
+            return None
+        with open(self.__path, 'r') as fin:
+            state = json.load(fin)
+        if state.get('batch_size') != batch_size:
+            return None
+        self.__state = state
+        return state
+
+    def start(self, batch_size, record_ids):
+        """Record the partition of a new run."""
+        self.__state = {
+            'batch_size': batch_size,
+            'record_ids': record_ids,
+            'completed': 0,
+            'offset': 0
+            }
+        self.__save()
+
+    def complete_batch(self, offset):
+        """Record a finished batch and the output size after writing it."""
+        self.__state['completed'] += 1
+        self.__state['offset'] = offset
+        self.__save()
+
+    def clear(self):
+        """Remove the saved state once the run has finished."""
+        if os.path.isfile(self.__path):
+            os.remove(self.__path)
+
+    def __save(self):
+        """Atomically write the state to disk."""
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump(self.__state, fout)
+        os.replace(tmp_path, self.__path)
+
+
+def fetch_batched(database_url, api_token, outfile, batch_size,
+                  pseudonymizer):
+    """Page through the project export and scrub each batch as it arrives."""
+    logger = logging.getLogger(__name__)
+    progress = BatchProgress(outfile + '.progress')
+    state = progress.load(batch_size)
+    if state and os.path.isfile(outfile):
+        logger.info('resuming after batch %d', state['completed'])
+        record_ids = state['record_ids']
+        # Discard any rows written by an interrupted batch.
+        with open(outfile, 'r+') as fout:
+            fout.truncate(state['offset'])
+    else:
+        record_ids = fetch_record_ids(database_url, api_token)
+        progress.start(batch_size, record_ids)
+        state = {'completed': 0}
+        open(outfile, 'w').close()
+    batches = [record_ids[i:i+batch_size]
+               for i in range(0, len(record_ids), batch_size)]
+    for number in range(state['completed'], len(batches)):
+        logger.info('fetching batch %d of %d', number + 1, len(batches))
+        params = {'records[%d]' %i: record_id
+                  for i, record_id in enumerate(batches[number])}
+        response = export_records(database_url, api_token, stream=True,
+                                  **params)
+        with open(outfile, 'a', newline='') as fout:
+            writer = csv.writer(fout)
+            reader = csv.reader(stream_text(response))
+            header = next(reader, None)
+            if header is not None:
+                if fout.tell() == 0:
+                    writer.writerow(header)
+                pseudonymizer.set_header(header)
+                writer.writerows(scrub_rows(reader, pseudonymizer))
+            offset = fout.tell()
+        progress.complete_batch(offset)
+    progress.clear()
+
+
+def get_server_time(database_url, api_token):
+    """Return the current time of the REDCap server in its own timezone.
+
+    REDCap compares dateRangeBegin with its local time, which is set with
+    REDCAP_TIMEZONE when it differs from the timezone of this machine.
+    """
+    response = export_records(database_url, api_token, content='version')
+    date = response.headers.get('Date')
+    if date:
+        now = email.utils.parsedate_to_datetime(date)
+    else:
+        logging.getLogger(__name__).warning(
+            'the server sent no Date header, using the local clock')
+        now = datetime.datetime.now(datetime.timezone.utc)
+    timezone = os.environ.get('REDCAP_TIMEZONE')
+    if timezone:
+        return now.astimezone(zoneinfo.ZoneInfo(timezone))
+    return now.astimezone()
+
+
+def get_watermark(database_url, api_token):
+    """Return the watermark of a sync starting now."""
+    started = get_server_time(database_url, api_token) - WATERMARK_OVERLAP
+    return started.strftime(WATERMARK_FORMAT)
+
+
+def clear_delta(raw_dir):
+    """Remove the changes left for an incremental build by an earlier sync."""
+    path = os.path.join(raw_dir, DELTA_FILENAME)
+    if os.path.isfile(path):
+        logging.getLogger(__name__).info('removing the stale %s', path)
+        os.remove(path)
+
+
+class SyncState(object):
+
+    def __init__(self, path):
+        """Initialize a SyncState object."""
+        self.__path = path
+
+    def get_watermark(self):
+        """Return the start time of the last successful sync, if any."""
+        if not os.path.isfile(self.__path):
+            return None
+        with open(self.__path, 'r') as fin:
+            return json.load(fin).get('last_sync')
+
+    def set_watermark(self, watermark):
+        """Atomically persist the start time of a successful sync."""
+        tmp_path = self.__path + '.tmp'
+        with open(tmp_path, 'w') as fout:
+            json.dump({'last_sync': watermark}, fout)
+        os.replace(tmp_path, self.__path)
+
+
+def record_delta(path, header, rows):
+    """Append changed rows to the delta consumed by incremental builds."""
+    with open(path, 'a', newline='') as fout:
+        writer = csv.writer(fout)
+        if fout.tell() == 0:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+
+def merge_records(outfile, header, changes):
+    """Merge changed rows into the raw file, keyed by record and event."""
+    tmp_path = outfile + '.tmp'
+    with open(outfile, 'r', newline='') as fin, \
+            open(tmp_path, 'w', newline='') as fout:
+        reader = csv.reader(fin)
         writer = csv.writer(fout)
-        reader = csv.reader(data)
+        existing_header = next(reader, None)
+        if existing_header != header:
+            raise ValueError('The export header no longer matches raw.csv; '
+                             'run a full fetch instead.')
+        writer.writerow(header)
         for row in reader:
-            if row[1] == 'event_2_arm_1':
-                continue
-            for index, col in enumerate(row):
-                if col != '' and re.match(pattern, col):
-                    if not col in hashes:
-                        m.update(col.encode('utf-8'))
-                        hashes[col] = m.hexdigest()
-                    row[index] = hashes[col]
-            writer.writerow(row)
+            writer.writerow(changes.pop((row[0], row[1]), row))
+        # Whatever remains was created since the last sync.
+        writer.writerows(changes.values())
+    os.replace(tmp_path, outfile)
+
+
+def fetch_incremental(database_url, api_token, outfile, pseudonymizer,
+                      batch_size=None):
+    """Fetch only the records changed since the last sync."""
+    logger = logging.getLogger(__name__)
+    sync_state = SyncState(os.path.join(os.path.dirname(outfile),
+                                        'sync_state.json'))
+    watermark = sync_state.get_watermark()
+    # Taken before the export so that changes saved during it are not lost.
+    started = get_watermark(database_url, api_token)
+    if watermark is None or not os.path.isfile(outfile):
+        logger.info('no previous sync found, fetching all records')
+        clear_delta(os.path.dirname(outfile))
+        if batch_size:
+            fetch_batched(database_url, api_token, outfile, batch_size,
+                          pseudonymizer)
+        else:
+            fetch_all(database_url, api_token, outfile, pseudonymizer)
+        sync_state.set_watermark(started)
+        return
+    logger.info('fetching records changed since %s', watermark)
+    response = export_records(database_url, api_token, stream=True,
+                              dateRangeBegin=watermark)
+    reader = csv.reader(stream_text(response))
+    header = next(reader, None)
+    if header is None:
+        sync_state.set_watermark(started)
+        return
+    pseudonymizer.set_header(header)
+    changes = {}
+    for row in scrub_rows(reader, pseudonymizer):
+        changes[(row[0], row[1])] = row
+    if changes:
+        logger.info('merging %d changed rows', len(changes))
+        record_delta(os.path.join(os.path.dirname(outfile), DELTA_FILENAME),
+                     header, changes.values())
+        merge_records(outfile, header, changes)
+    sync_state.set_watermark(started)
+
+
+def fetch_all(database_url, api_token, outfile, pseudonymizer):
+    """Fetch the whole project with a single streamed export request."""
+    logger = logging.getLogger(__name__)
+    logger.info('hashing emails and saving data')
+    with open(outfile, 'w', newline='') as fout:
+        writer = csv.writer(fout)
+        writer.writerows(stream_records(database_url, api_token,
+                                        pseudonymizer))
+
+
+def main(batch_size=None, incremental=False, refresh_dictionary=False):
+    """Fetching the raw data from REDCap."""
+    logger = logging.getLogger(__name__)
+
+    logger.info('fetching raw data from database')
+    database_url = os.environ.get("DATABASE_URL")
+    api_token = os.environ.get("API_TOKEN")
+    raw_dir = os.path.join(project_dir, 'data', 'raw')
+    outfile = os.path.join(raw_dir, 'raw.csv')
+    data_dictionary = os.path.join(project_dir, 'docs', 'data_dictionary.csv')
+    if refresh_dictionary:
+        logger.info('refreshing the data dictionary')
+        fetch_metadata(database_url, api_token, data_dictionary)
+    pseudonymizer = Pseudonymizer(os.environ.get("PSEUDONYM_KEY"),
+                                  get_email_fields(data_dictionary))
+    remove_legacy_map(raw_dir)
+    with profiling.stage('fetch'):
+        if incremental:
+            fetch_incremental(database_url, api_token, outfile,
+                              pseudonymizer, batch_size)
+        else:
+            # A full fetch is followed by a full build, not by the delta.
+            clear_delta(raw_dir)
+            if batch_size:
+                logger.info('streaming in batches of %d records', batch_size)
+                fetch_batched(database_url, api_token, outfile, batch_size,
+                              pseudonymizer)
+            else:
+                fetch_all(database_url, api_token, outfile, pseudonymizer)
 
 
 if __name__ == "__main__":
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
+    parser = argparse.ArgumentParser(description='Fetch the raw REDCap data.')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='stream the export in batches of this many '
+                             'records, resuming interrupted runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch records changed since the last sync '
+                             'and merge them into the existing raw data')
+    parser.add_argument('--refresh-dictionary', action='store_true',
+                        help='replace the data dictionary with the project '
+                             'metadata exported from REDCap')
+    args = parser.parse_args()
+
     # store the project dir as a variable
     project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
 
@@ -53,4 +454,4 @@ if __name__ == "__main__":
     # load up the .env entries as environment variables
     load_dotenv(find_dotenv())
 
-    main()
+    main(args.batch_size, args.incremental, args.refresh_dictionary)
@@ -1,9 +1,117 @@
+from concurrent.futures import ProcessPoolExecutor
+import argparse
 import csv
 import logging
 import os
-import re
+import queue
 import shutil
 import sqlite3
+import sys
+import tempfile
+import threading
+
+import numpy as np
+import pandas as pd
+
+# store necessary paths and variables
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+data_dir = os.path.join(project_dir, 'data')
+raw_filepath = os.path.join(data_dir, 'raw', 'raw.csv')
+processed_filepath = os.path.join(data_dir, 'processed', 'processed.db')
+delta_filepath = os.path.join(data_dir, 'raw', 'delta.csv')
+metrics_filepath = os.path.join(data_dir, 'processed', 'metrics.json')
+postal_cache_filepath = os.path.join(data_dir, 'processed', 'postal_cache.db')
+data_dictionary = os.path.join(project_dir, 'docs', 'data_dictionary.csv')
+PIPELINE_QUEUE_SIZE = 16 # chunks in flight between fetching and loading
+PIPELINE_CHUNK_SIZE = 500 # rows per chunk
+BULK_BATCH_SIZE = 5000 # records per executemany call
+SQL_VARIABLE_LIMIT = 500 # values bound per IN (...) clause
+LOAD_PRAGMAS = [
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-65536'), # 64 MiB
+    ('temp_store', 'MEMORY')
+    ]
+# Forms exported as the user info, dog and feedback tables.
+USER_FORM = 'phase_1_welcome'
+DOG_FORM = 'phase_1'
+FEEDBACK_FORM = 'phase_1_feedback'
+# Dog fields of the current, neutered and onset ages in months or years.
+AGE_FIELDS = [
+    ('dog_age_today_months', 'dog_age_today_years'),
+    ('dog_sex_month', 'dog_sex_year'),
+    ('q01_age_months', 'q01_age_years')
+    ]
+# Column types that differ from the data dictionary because the values are
+# rewritten during the load.
+TYPE_OVERRIDES = {
+    'record_id': 'INTEGER', # replaced by the user ID
+    'purebred_breed': 'TEXT', # translated to the breed name
+    'dog_age_today_months': 'REAL', # parsed ages
+    'dog_sex_month': 'REAL',
+    'q01_age_months': 'REAL'
+    }
+
+# Radio fields of the dogs table that are expanded into one indicator
+# column per choice, e.g. q06_soil_type_1 to q06_soil_type_3.
+EXPANDED_FIELDS = ['q06_soil_type']
+
+# Dogs that were not enrolled because of the behavior problem under study.
+BIAS_FILTER = ('question_reason_for_part_3 = 0 '
+               'OR (question_reason_for_part_3 = 1 AND q01_main IS NOT 1)')
+INDEXES = [
+    ('users', ['record_id']),
+    ('users', ['email']),
+    ('users', ['question_reason_for_part_3']),
+    ('feedback', ['record_id']),
+    ('dogs', ['record_id', 'dog_name']), # also serves record_id lookups
+    ('dogs', ['q01_main'])
+    ]
+# Columns of the users table with the normalized postal code, its candidate
+# countries, the resolved country and the confidence in it, with their types
+# and whether they are indexed.
+POSTAL_COLUMNS = [
+    ('postal_code', 'TEXT', True),
+    ('postal_countries', 'TEXT', False),
+    ('country', 'TEXT', True),
+    ('postal_confidence', 'REAL', False)
+    ]
+
+# Imports from neighbor directories.
+sys.path.append(project_dir)
+from src.utilities import data_dictionary as datadict
+from src.utilities import parquet_tables
+from src.utilities import profiling
+from src.utilities import run_metrics
+from src.features import postal_index
+from src.features import postal_recovery
+from src.data import age_parser
+
+METRICS = run_metrics.Metrics(profiling.get_profiler())
+DICTIONARY = datadict.DataDictionary(data_dictionary)
+BREED_REFERENCE = DICTIONARY.get_breeds()
+# Raw export columns of the user info, the dog forms and the feedback; the
+# last dog form lacks a column.
+USER_COLUMNS = slice(*DICTIONARY.get_blocks(USER_FORM)[0])
+USER_INFO_COLUMNS = slice(USER_COLUMNS.start + 1, USER_COLUMNS.stop)
+DOG_BLOCKS = DICTIONARY.get_blocks(DOG_FORM)
+FEEDBACK_COLUMNS = slice(*DICTIONARY.get_blocks(FEEDBACK_FORM)[0])
+DOG_WIDTH = DOG_BLOCKS[0][1] - DOG_BLOCKS[0][0] # columns of a full dog form
+MISSING_COLUMN = DICTIONARY.get_column(DOG_FORM,
+                                       datadict.REPEATED_FORMS[DOG_FORM][1])
+# Raw export columns of the event, the user and the form statuses.
+EVENT_COLUMN = DICTIONARY.get_column(USER_FORM, datadict.EVENT_COLUMN)
+USER_COLUMN = DICTIONARY.get_column(USER_FORM, 'email')
+USER_STATUS_COLUMN = USER_COLUMNS.stop - 1
+FEEDBACK_STATUS_COLUMN = FEEDBACK_COLUMNS.stop - 1
+# Dog data columns, which follow the user ID, rewritten while cleaning.
+BREED_COLUMN = DICTIONARY.get_column(DOG_FORM, 'purebred_breed') + 1
+SOURCE_COLUMN = DICTIONARY.get_column(DOG_FORM, 'acquisition_source') + 1
+AGE_COLUMNS = [(DICTIONARY.get_column(DOG_FORM, months) + 1,
+                DICTIONARY.get_column(DOG_FORM, years) + 1)
+               for months, years in AGE_FIELDS]
+CURRENT_AGE, NEUTERED_AGE, ONSET_AGE = [months for months, _ in AGE_COLUMNS]
+CLEANED_COLUMNS = (BREED_COLUMN, SOURCE_COLUMN) + sum(AGE_COLUMNS, ())
 
 
 def get_data_file():
@@ -15,183 +123,173 @@ def get_data_file():
         quit()
 
 
-def parse_contents(line, unit):
-    try:
-        original = line
-        # Make lowercase and remove whitespace.
-        line = line.lower().replace(' ', '')
-        line = convert_words(line)
-        # Return no result when no digits in input.
-        if not bool(re.search('\d', line)):
-            raise ValueError('No digits: %s' %original)
-        # First check for purely digit strings.
-        months = parse_pure(line, unit)
-        if months > 0:
-            # Eliminate ages that are significantly older than the world record.
-            if months > 384:
-                raise ValueError('Extreme outlier: %s %s' %(original, unit))
-            return ('%.2f' %months)
-        # Convert fractions to decimals.
-        line = parse_fraction(line)
-        if not line:
-            raise ValueError('Invalid fractions: %s' %original)
-        # Convert ranges to averages.
-        line = parse_range(line)
-        if not line:
-            raise ValueError('Invalid range: %s' %original)
-        # Parse out weeks, months, and years.
-        months1, line = parse_weeks(line)
-        months2, line = parse_months(line)
-        months3, line = parse_years(line)
-        # Perform addition when applicable.
-        line = parse_math(line)
-        # Account for european use of comma.
-        line = line.replace(',', '.')
-        # Parse out any formed purely digit strings.
-        months4, line = parse_impure(line, unit)
-        # If digits remain, the input is invalid.
-        if bool(re.search('\d', line)):
-            raise ValueError('Extra digits: %s' %original)
-        months = months1 + months2 + months3 + months4
-        if months == 0:
-            raise ValueError('No parsed value: %s' %original)
-        # Eliminate ages that are significantly older than the world record.
-        if months > 384:
-            raise ValueError('Extreme outlier: %s %s' %(original, unit))
-        return ('%.2f' %months)
-    except ValueError as err:
-        #print(err.args)
-        return ''
-
-
-def convert_words(line):
-    words = {'half': '.5', 'one': '1', 'two': '2', 'three': '3', 'four': '4', 'five': '5',
-             'six': '6', 'seven': '7', 'eight': '8', 'nine': '9', 'ten': '10',
-             'eleven': '11', 'twelve': '12'}
-    for word in words:
-        if word in line:
-            line = line.replace(word, words[word])
-    return line
-
-
-def parse_pure(line, unit):
-    months = 0
+def parse_column(values, unit, ages):
+    """Parse a column of ages through the age cache."""
+    return pd.Series(ages.parse_many(values, unit), index=values.index,
+                     dtype=object)
+
+
+def chunked(values, size):
+    """Split a list of values into lists of at most size values."""
+    values = list(values)
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
+
+def export_parquet(enabled=False):
+    """Export the processed tables as Parquet files beside the database.
+
+    Without an export, the files of an earlier one no longer match the
+    database and are removed.
+    """
+    logger = logging.getLogger(__name__)
+    directory = os.path.dirname(processed_filepath)
+    if not enabled:
+        parquet_tables.remove_tables(directory)
+        return
+    logger.info('exporting Parquet tables')
+    METRICS.start('export')
+    conn = sqlite3.connect(processed_filepath)
     try:
-        if unit == 'y':
-            months = float(line) * 12
-        else:
-            months = float(line)
-        return months
-    except ValueError:
-        return 0
-
-
-def parse_fraction(line):
-    fractions = {'1/2': '.5', '1/12': '.083', '1/3': '.33', '1/4': '.25',
-                 '3/4': '.75', '1/5': '.2'}
-    for frac in fractions:
-        if frac in line:
-            line = line.replace(frac, fractions[frac])
-    # Clear the lines of invalid fractions.
-    if bool(re.search('\/', line)):
-        return ''
-    return line
-
-
-def parse_range(line):
-    opers = ['-', 'or', 'to', '..']
-    for oper in opers:
-        if oper in line:
-            if oper == '..':
-                oper = '\.\.'
-            pattern = '([0-9\.]+){}([0-9\.]+)'.format(oper)
-            m = re.search(pattern, line)
-            if m:
-                lhs = float(m.group(1))
-                rhs = float(m.group(2))
-                # If the rhs is lower, and the operator is '-', then the rhs is additive.
-                if lhs > rhs:
-                    avg = lhs + rhs
-                else:
-                    avg = (lhs + rhs) / 2
-                line = re.sub(pattern, str(avg), line)
-    return line
-
-
-def parse_weeks(line):
-    months = 0
-    pattern = '([0-9\.]+)(weeks)+'
-    m = re.search(pattern, line)
-    if m:
-        months = float(m.group(1)) / 4
-        line = re.sub(pattern, '', line)
-    return months, line
-
-
-def parse_months(line):
-    months = 0
-    pattern = '([0-9\.]+)(months|mon)+'
-    m = re.search(pattern, line)
-    if m:
-        months = float(m.group(1))
-        line = re.sub(pattern, '', line)
-    return months, line
-
-
-def parse_years(line):
-    months = 0
-    pattern = '([0-9\.]+).?([y,e,a,r,s]{3}|y)+'
-    m = re.search(pattern, line)
-    if m:
-        months = float(m.group(1)) * 12
-        line = re.sub(pattern, '', line)
-    return months, line
-
-
-def parse_math(line):
-    opers = ['+', 'anda', 'and', '&']
-    for oper in opers:
-        if oper in line:
-            pattern = '([0-9\.]+){}([0-9\.]+)'.format(oper)
-            m = re.search(pattern, line)
-            if m:
-                lhs = float(m.group(1))
-                rhs = float(m.group(2))
-                result = lhs + rhs
-                line = re.sub(pattern, str(result), line)
-    return line
-
-
-def parse_impure(line, unit):
-    months = 0
-    pattern = '([0-9]+\.[0-9]+|[0-9]+)'
-    m = re.findall(pattern, line)
-    if len(m) == 1:
+        if not parquet_tables.write_tables(conn, directory):
+            logger.info('pyarrow is not installed, skipping the Parquet '
+                        'export')
+    finally:
+        conn.close()
+
+
+def fetch_rows(batch_size=None):
+    """Yield the export header and scrubbed rows straight from REDCap."""
+    # The fetcher needs the network dependencies, so only import it here.
+    from src.data import fetch_raw_data
+    fetch_raw_data.load_dotenv(fetch_raw_data.find_dotenv())
+    pseudonymizer = fetch_raw_data.Pseudonymizer(
+        os.environ.get('PSEUDONYM_KEY'),
+        fetch_raw_data.get_email_fields(data_dictionary))
+    fetch_raw_data.remove_legacy_map(os.path.join(data_dir, 'raw'))
+    yield from fetch_raw_data.stream_records(
+        os.environ.get('DATABASE_URL'), os.environ.get('API_TOKEN'),
+        pseudonymizer, batch_size)
+
+
+def read_columns(source):
+    """Read the raw export, including its header row, as string columns."""
+    if isinstance(source, str):
+        return pd.read_csv(source, header=None, dtype=object,
+                           keep_default_na=False)
+    return pd.DataFrame(list(source))
+
+
+class RowPipeline(object):
+
+    def __init__(self, rows, side_output=None):
+        """Initialize a RowPipeline object."""
+        self.__rows = rows
+        self.__side_output = side_output
+        self.__queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__produce, daemon=True)
+
+    def __produce(self):
+        """Move rows from the source onto the queue in chunks."""
+        fout = None
         try:
-            if unit == 'y':
-                months = float(m[0]) * 12
-            else:
-                months = float(m[0])
-            line = re.sub(pattern, '', line)
-            return months, line
-        except ValueError:
-            return 0, line
-    return months, line
-
-
-def get_breed_dict():
-    combo_list = []
-    with open(data_dictionary, newline='', encoding='latin1') as csvfile:
-        csvreader = csv.reader(csvfile, delimiter=',')
-        for row in csvreader:
-            if row[0] == 'purebred_breed':
-                combo_list = list(row[5].split("|"))
+            if self.__side_output:
+                fout = open(self.__side_output, 'w', newline='')
+                writer = csv.writer(fout)
+            chunk = []
+            for row in self.__rows:
+                chunk.append(row)
+                if len(chunk) == PIPELINE_CHUNK_SIZE:
+                    if fout:
+                        writer.writerows(chunk)
+                    self.__queue.put(chunk)
+                    chunk = []
+            if chunk:
+                if fout:
+                    writer.writerows(chunk)
+                self.__queue.put(chunk)
+        except Exception as err:
+            self.__error = err
+        finally:
+            if fout:
+                fout.close()
+            self.__queue.put(None)
+
+    def __iter__(self):
+        """Yield the rows while the source is still producing them."""
+        self.__thread.start()
+        while True:
+            chunk = self.__queue.get()
+            if chunk is None:
                 break
-    breeds = {}
-    for combo in combo_list:
-        sep = list(combo.split(", "))
-        breeds[sep[0].strip()] = sep[1].strip()
-    return breeds
+            yield from chunk
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+
+
+def to_integer(value):
+    """Convert a raw value for an INTEGER column."""
+    if value is None or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def to_real(value):
+    """Convert a raw value for a REAL column."""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+class TableSchema(object):
+
+    def __init__(self, header, dictionary):
+        """Initialize a TableSchema object."""
+        self.__header = header
+        self.__types = [TYPE_OVERRIDES.get(column)
+                        or dictionary.get_sql_type(column)
+                        for column in header]
+        converters = {'INTEGER': to_integer, 'REAL': to_real}
+        self.__converters = [(index, converters[sql_type])
+                             for index, sql_type in enumerate(self.__types)
+                             if sql_type in converters]
+
+    def get_header(self):
+        """Return the column names."""
+        return self.__header
+
+    def get_types(self):
+        """Return the SQLite column types."""
+        return self.__types
+
+    def convert(self, record):
+        """Return a record's raw strings as a tuple of the column types."""
+        record = list(record)
+        for index, converter in self.__converters:
+            record[index] = converter(record[index])
+        return tuple(record)
+
+    def convert_columns(self, records):
+        """Convert an array of raw strings to the column types in place."""
+        columns = {}
+        for index, converter in self.__converters:
+            columns.setdefault(converter, []).append(index)
+        for converter, indexes in columns.items():
+            # Convert each distinct value of the columns of a type only once.
+            values = records[:, indexes]
+            codes, uniques = pd.factorize(values.ravel(),
+                                          use_na_sentinel=False)
+            converted = np.empty(len(uniques), dtype=object)
+            converted[:] = [converter(value) for value in uniques]
+            records[:, indexes] = converted[codes].reshape(values.shape)
+        return records
 
 
 class Database(object):
@@ -200,6 +298,7 @@ class Database(object):
         """Initialize a Database object."""
         self.__conn = sqlite3.connect(path)
         self.__cursor = self.__conn.cursor()
+        self.__statements = {}
 
     def close(self):
         """Terminate the connection to the database."""
@@ -209,49 +308,175 @@ class Database(object):
         """Commit changes to the database."""
         self.__conn.commit()
 
+    def get_connection(self):
+        """Return the connection to the database."""
+        return self.__conn
+
+    def configure_for_load(self):
+        """Apply the PRAGMAs used while bulk loading."""
+        for pragma, value in LOAD_PRAGMAS:
+            self.__cursor.execute('PRAGMA %s = %s;' %(pragma, value))
+
+    def begin(self):
+        """Open an explicit transaction."""
+        self.__cursor.execute('BEGIN;')
+
     def get_count(self, table, modifiers=''):
         """Return the record count for the provided table."""
         query = 'SELECT COUNT(*) FROM %s %s;' %(table, modifiers)
         self.__cursor.execute(query)
         return self.__cursor.fetchone()[0]
 
-    def create_table(self, table, header):
+    def create_table(self, table, header, types=None):
         """Create a table in the database."""
-        fields = ' TEXT, '.join(header)
+        if types is None:
+            types = ['TEXT'] * len(header)
+        fields = ', '.join('%s %s' %pair for pair in zip(header, types))
         query = 'CREATE TABLE %s (%s);' %(table, fields)
         self.__cursor.execute(query)
 
-    def insert_record(self, table, record):
+    def insert_record(self, table, record, columns=None):
         """Insert record into the database table."""
         placeholder = '?'
         placeholders = ', '.join(placeholder * len(record))
+        if columns:
+            # Name the columns when the table has gained derived ones.
+            table = '%s (%s)' %(table, ', '.join(columns))
         query = 'INSERT INTO %s VALUES (%s);' %(table, placeholders)
         self.__cursor.execute(query, record)
 
+    def get_table_counts(self):
+        """Return the user and dog counts of the metrics in one query."""
+        self.__cursor.execute(
+            'SELECT COUNT(*), '
+            'COALESCE(SUM(phase_1_welcome_complete=0), 0), '
+            'COALESCE(SUM(phase_1_feedback_complete=2), 0), '
+            '(SELECT COUNT(*) FROM dogs) '
+            'FROM users LEFT JOIN feedback USING (record_id);')
+        users, invalid, complete, dogs = self.__cursor.fetchone()
+        return {'users': {'total': users, 'invalid': invalid,
+                          'complete': complete},
+                'dogs': {'total': dogs}}
+
+    def get_user_id(self, user):
+        """Return the stored user ID for a user pseudonym, if any."""
+        self.__cursor.execute('SELECT record_id FROM users WHERE email=?;',
+                              (user,))
+        row = self.__cursor.fetchone()
+        return row[0] if row else None
+
+    def get_last_user_id(self):
+        """Return the largest stored user ID."""
+        self.__cursor.execute('SELECT MAX(record_id) FROM users;')
+        return self.__cursor.fetchone()[0] or 0
+
+    def update_record(self, table, record, columns=None):
+        """Replace the stored record that has the same record ID."""
+        query = 'DELETE FROM %s WHERE record_id=?;' %table
+        self.__cursor.execute(query, (record[0],))
+        self.insert_record(table, record, columns)
+
+    def delete_records(self, table, record_ids):
+        """Delete the records of the provided record IDs."""
+        for chunk in chunked(record_ids, SQL_VARIABLE_LIMIT):
+            self.__cursor.execute('DELETE FROM %s WHERE record_id IN (%s);'
+                                  %(table, ', '.join('?' * len(chunk))),
+                                  chunk)
+
+    def update_dog(self, record, columns=None):
+        """Replace the stored dog with the same owner and normalized name."""
+        self.__cursor.execute('SELECT rowid, dog_name FROM dogs '
+                              'WHERE record_id=?;', (record[0],))
+        name = str(record[1]).lower()
+        rowids = [(rowid,) for rowid, dog_name in self.__cursor.fetchall()
+                  if str(dog_name).lower() == name]
+        self.__cursor.executemany('DELETE FROM dogs WHERE rowid=?;', rowids)
+        self.insert_record('dogs', record, columns)
+
+    def insert_records(self, table, records, columns=None):
+        """Insert a batch of records into the database table."""
+        if not records:
+            return
+        # Reusing the same statement text lets sqlite3 reuse the prepared
+        # statement for every batch of the table.
+        key = (table, tuple(columns or ()))
+        query = self.__statements.get(key)
+        if query is None:
+            placeholders = ', '.join('?' * len(records[0]))
+            target = table
+            if columns:
+                target = '%s (%s)' %(table, ', '.join(columns))
+            query = 'INSERT INTO %s VALUES (%s);' %(target, placeholders)
+            self.__statements[key] = query
+        self.__cursor.executemany(query, records)
+
+    def attach(self, path, name):
+        """Attach another database under a schema name."""
+        self.__cursor.execute('ATTACH DATABASE ? AS %s;' %name, (path,))
+
+    def detach(self, name):
+        """Detach an attached database."""
+        self.__cursor.execute('DETACH DATABASE %s;' %name)
+
+    def stage_table(self, table):
+        """Create an empty staging table for records of a table."""
+        self.__cursor.execute('CREATE TEMP TABLE staging_%s AS '
+                              'SELECT rowid AS staged_row, * FROM main.%s '
+                              'WHERE 0;' %(table, table))
+
+    def stage_records(self, table, schema):
+        """Copy the records of a table in an attached database to staging."""
+        self.__cursor.execute('INSERT INTO staging_%s SELECT rowid, * '
+                              'FROM %s.%s;' %(table, schema, table))
+
+    def insert_staged(self, table, columns):
+        """Insert the staged records ordered by record ID and drop them."""
+        columns = ', '.join(columns)
+        self.__cursor.execute('INSERT INTO main.%s (%s) SELECT %s '
+                              'FROM staging_%s ORDER BY record_id, staged_row;'
+                              %(table, columns, columns, table))
+        self.__cursor.execute('DROP TABLE staging_%s;' %table)
+
 
 class Manager(object):
 
-    def __init__(self, path):
+    def __init__(self, rows, incremental=False, batch_size=None,
+                 columnar=False, path=None, lookup=None):
         """Initialize a Manager object."""
-        self.__db = Database(processed_filepath)
-        self.__path = path
+        self.__db = Database(path or processed_filepath)
+        self.__ages = age_parser.AgeCache(self.__db.get_connection())
+        self.__incremental = incremental
+        self.__lookup = lookup # finds the preassigned ID of a user
+        self.__batch_size = batch_size # users per streamed batch
         self.__headers = {}
-        self.__parse_headers()
+        self.__schemas = {}
         self.__data = {}
-        self.__parse_data()
+        self.__records = None # table records of the columnar engine
+        self.__row_count = 0 # raw rows parsed
+        if columnar:
+            # The rows are a frame read by read_columns.
+            self.__row_count = len(rows) - 1
+            self.__parse_headers(list(rows.iloc[0]))
+            self.__records = ColumnarStore(rows.iloc[1:],
+                                           self.__ages).get_records()
+            return
+        rows = iter(rows)
+        self.__parse_headers(next(rows))
+        if batch_size:
+            # The rows are parsed while the tables are streamed.
+            self.__rows = rows
+        else:
+            self.__parse_data(rows)
 
     def __del__(self):
         """Destructor for the Manager object."""
         self.__db.close()
 
-    def __parse_headers(self):
-        """Parse headers from the data file."""
-        with open(self.__path, 'r') as fin:
-            for row in csv.reader(fin, delimiter=','):
-                self.__headers['users'] = row[0:11]
-                self.__headers['dogs'] = row[11:146]
-                self.__headers['feedback'] = row[685:689]
-                break
+    def __parse_headers(self, row):
+        """Parse headers from the header row."""
+        self.__headers['users'] = row[USER_COLUMNS]
+        self.__headers['dogs'] = row[slice(*DOG_BLOCKS[0])]
+        self.__headers['feedback'] = row[FEEDBACK_COLUMNS]
         # Add the record_id field to all headers
         self.__headers['dogs'].insert(0, self.__headers['users'][0])
         self.__headers['feedback'].insert(0, self.__headers['users'][0])
@@ -259,172 +484,309 @@ class Manager(object):
         for key, value in self.__headers.items():
             h = value
             for i in range(len(h)):
-                h[i] = re.sub('_1[a-e]', '', h[i])
-                h[i] = re.sub('___', '_', h[i])
-
-    def __parse_data(self):
-        """Parse data from the data file."""
-        datastore = Datastore()
-        with open(self.__path, 'r') as fin:
-            for row in csv.reader(fin, delimiter=','):
-                datastore.add_entry(row)
+                h[i] = datadict.clean_column(h[i])
+            self.__schemas[key] = TableSchema(h, DICTIONARY)
+
+    def __parse_data(self, rows):
+        """Parse data from the remaining rows."""
+        if self.__incremental:
+            # Keep the IDs of participants that are already stored.
+            datastore = Datastore(self.__ages, self.__schemas,
+                                  self.__db.get_user_id,
+                                  self.__db.get_last_user_id())
+        elif self.__lookup:
+            datastore = Datastore(self.__ages, self.__schemas, self.__lookup)
+        else:
+            datastore = Datastore(self.__ages, self.__schemas)
+        for row in rows:
+            datastore.add_entry(row)
+            self.__row_count += 1
         self.__data = datastore.get_users()
 
     def create_tables(self):
         """Generate tables with the generated headers."""
-        self.__db.create_table('users', self.__headers['users'])
-        self.__db.create_table('dogs', self.__headers['dogs'])
-        self.__db.create_table('feedback', self.__headers['feedback'])
+        for table in ('users', 'dogs', 'feedback'):
+            schema = self.__schemas[table]
+            self.__db.create_table(table, schema.get_header(),
+                                   schema.get_types())
 
     def populate_tables(self):
         """Populate the generated tables with the raw data."""
+        self.__db.configure_for_load()
+        self.__db.begin()
+        if self.__records is not None:
+            for table, records in self.__records.items():
+                records = self.__schemas[table].convert_columns(records)
+                for chunk in chunked(records.tolist(), BULK_BATCH_SIZE):
+                    self.__db.insert_records(table, chunk)
+            self.__ages.flush()
+            self.__db.commit()
+            return
+        batches = {'users': [], 'feedback': [], 'dogs': []}
         for user, user_entry in self.__data.items():
-            self.__db.insert_record('users', user_entry.get_user_info())
-            self.__db.insert_record('feedback', user_entry.get_feedback())
-            dog_entries = user_entry.get_dogs()
-            for dog_entry in dog_entries:
-                self.__db.insert_record('dogs', dog_entry.get_data())
+            # The entries hold their converted records, so they are batched
+            # without copying.
+            batches['users'].append(user_entry.get_user_info())
+            batches['feedback'].append(user_entry.get_feedback())
+            for dog_entry in user_entry.get_dogs():
+                batches['dogs'].append(dog_entry.get_data())
+            if len(batches['dogs']) >= BULK_BATCH_SIZE:
+                self.__flush(batches)
+        self.__flush(batches)
+        self.__ages.flush()
+        self.__db.commit()
+
+    def __flush(self, batches, columns=False):
+        """Insert and clear the pending record batches."""
+        for table, records in batches.items():
+            header = self.__schemas[table].get_header() if columns else None
+            self.__db.insert_records(table, records, header)
+            records.clear()
+
+    def merge_shards(self, paths):
+        """Merge the tables of shard databases in record ID order."""
+        tables = ('users', 'dogs', 'feedback')
+        # Changing the temp store drops temporary tables, so configure first.
+        self.__db.configure_for_load()
+        for table in tables:
+            self.__db.stage_table(table)
+        for path in paths:
+            self.__db.attach(path, 'shard')
+            self.__db.begin()
+            for table in tables:
+                self.__db.stage_records(table, 'shard')
+            self.__ages.merge('shard')
+            self.__db.commit()
+            self.__db.detach('shard')
+        self.__db.begin()
+        for table in tables:
+            self.__db.insert_staged(table, self.__schemas[table].get_header())
         self.__db.commit()
 
+    def stream_tables(self):
+        """Populate the tables in batches of users while parsing the rows."""
+        self.__db.configure_for_load()
+        datastore = Datastore(self.__ages, self.__schemas,
+                              self.__db.get_user_id,
+                              self.__db.get_last_user_id())
+        for row in self.__rows:
+            datastore.add_entry(row)
+            self.__row_count += 1
+            if datastore.get_user_count() >= self.__batch_size:
+                self.__data = datastore.get_users()
+                self.update_tables()
+                datastore.clear()
+        self.__data = datastore.get_users()
+        self.update_tables()
+        self.__data = {}
+
     def update_tables(self):
-        """Update the generated tables with the raw data."""
+        """Upsert the raw data into the existing tables."""
+        self.__db.begin()
+        stored_uid = self.__db.get_last_user_id()
+        batches = {'users': [], 'feedback': [], 'dogs': []}
+        dogs = self.__schemas['dogs']
         for user, user_entry in self.__data.items():
-            self.__db.insert_record('users', user_entry.get_user_info())
-            self.__db.insert_record('feedback', user_entry.get_feedback())
-            dog_entries = user_entry.get_dogs()
-            for dog_entry in dog_entries:
-                self.__db.update_record('dogs', dog_entry.get_data())
+            user_info = user_entry.get_user_info()
+            user_feedback = user_entry.get_feedback()
+            dog_records = [dog_entry.get_data()
+                           for dog_entry in user_entry.get_dogs()]
+            if user_entry.get_uid() > stored_uid:
+                # Participants that are not stored yet are bulk inserted.
+                batches['users'].append(user_info)
+                batches['feedback'].append(user_feedback)
+                batches['dogs'].extend(dog_records)
+                continue
+            self.__upsert('users', user_info)
+            self.__upsert('feedback', user_feedback)
+            for record in dog_records:
+                # Dog entries are complete, so the newest one always wins.
+                self.__db.update_dog(record, dogs.get_header())
+        self.__flush(batches, columns=True)
+        self.__ages.flush()
         self.__db.commit()
+        return [user_entry.get_uid() for user_entry in self.__data.values()]
+
+    def replace_tables(self):
+        """Replace the stored records of the parsed users with new ones."""
+        self.__db.begin()
+        record_ids = [user_entry.get_uid()
+                      for user_entry in self.__data.values()]
+        for table in ('users', 'feedback', 'dogs'):
+            self.__db.delete_records(table, record_ids)
+        batches = {'users': [], 'feedback': [], 'dogs': []}
+        for user, user_entry in self.__data.items():
+            batches['users'].append(user_entry.get_user_info())
+            batches['feedback'].append(user_entry.get_feedback())
+            for dog_entry in user_entry.get_dogs():
+                batches['dogs'].append(dog_entry.get_data())
+        # The tables may have gained derived columns since the build.
+        self.__flush(batches, columns=True)
+        self.__ages.flush()
+        self.__db.commit()
+        return record_ids
+
+    def __upsert(self, table, record):
+        """Store a record, replacing a stored one only with a complete one."""
+        header = self.__schemas[table].get_header()
+        if not self.__db.get_count(table, 'WHERE record_id=%d' %record[0]):
+            self.__db.insert_record(table, record, header)
+        elif record[-1] == 2:
+            self.__db.update_record(table, record, header)
+
+    def get_age_counts(self):
+        """Return the hit and miss counters of the age cache."""
+        return self.__ages.get_counts()
+
+    def add_age_counts(self, counts, failures):
+        """Add the age cache counters of another manager."""
+        self.__ages.add_counts(counts, failures)
+
+    def get_age_failures(self):
+        """Return the counts of invalid ages by reason."""
+        return self.__ages.get_failures()
+
+    def get_schemas(self):
+        """Return the schema of every table."""
+        return self.__schemas
+
+    def get_row_count(self):
+        """Return the number of raw rows parsed."""
+        return self.__row_count
 
     def write_metrics(self):
-        """Write the database metrics."""
-        offset = '  '
-        with open(metrics_filepath, 'w') as fout:
-            fout.write('users:\n')
-            fout.write('%s- total: %d\n'
-                       %(offset, self.__db.get_count('users')))
-            mod = 'WHERE phase_1_welcome_complete="0"'
-            fout.write('%s- invalid: %d\n'
-                       %(offset, self.__db.get_count('users', mod)))
-            join = 'JOIN feedback ON users.record_id=feedback.record_id'
-            mod = '%s WHERE phase_1_feedback_complete="2"' %join
-            fout.write('%s- complete: %d\n'
-                       %(offset, self.__db.get_count('users', mod)))
-            fout.write('dogs:\n')
-            fout.write('%s- total: %d\n'
-                       %(offset, self.__db.get_count('dogs')))
+        """Write the run metrics report."""
+        METRICS.add_counters({'parse_failures': self.__ages.get_failures()})
+        METRICS.set_section('age_cache', self.__ages.get_counts())
+        METRICS.set_section('tables', self.__db.get_table_counts())
+        METRICS.write(metrics_filepath)
+
+
+def is_valid_entry(data):
+    """Return whether a raw row is a phase 1 entry."""
+    if data[EVENT_COLUMN] == 'redcap_event_name':
+        return False # header
+    elif data[EVENT_COLUMN] == 'event_2_arm_1':
+        return False # phase 2
+    else:
+        return True
 
 
 class DogEntry(object):
 
-    def __init__(self, uid, data):
+    __slots__ = ('__record',)
+
+    def __init__(self, uid, values, ages, schema):
         """Initialize a DogEntry object."""
-        self.__name = data[0]
-        self.__data = data
-        self.__verify_data()
-        self.__data.insert(0, uid)
+        # The cleaned columns are keyed like the dog data.
+        data = {i: values[i-1] for i in CLEANED_COLUMNS}
         # Convert breed reference index to breed.
-        if data[4]:
-            data[4] = BREED_REFERENCE[data[4]]
+        if data[BREED_COLUMN]:
+            data[BREED_COLUMN] = BREED_REFERENCE[data[BREED_COLUMN]]
         # Simplify acquisition source.
-        if data[8] == '4':
-            data[8] = '1'
-        # Convert current age to months.
-        if data[13]:
-            data[13] = parse_contents(data[13], 'm')
-        elif data[14]:
-            data[13] = parse_contents(data[14], 'y')
-            data[14] = ''
-        # Convert neutered age to months.
-        if data[18]:
-            data[18] = parse_contents(data[18], 'm')
-        elif data[19]:
-            data[18] = parse_contents(data[19], 'y')
-            data[19] = ''
-        # Convert onset age to months.
-        rnum = 26
-        if data[rnum]:
-            data[rnum] = parse_contents(data[rnum], 'm')
-        elif data[rnum+1]:
-            data[rnum] = parse_contents(data[rnum+1], 'y')
-            data[rnum+1] = ''
+        if data[SOURCE_COLUMN] == '4':
+            data[SOURCE_COLUMN] = '1'
+        # Convert the current, neutered and onset ages to months.
+        for months, years in AGE_COLUMNS:
+            if data[months]:
+                data[months] = ages.parse(data[months], 'm')
+            elif data[years]:
+                data[months] = ages.parse(data[years], 'y')
+                data[years] = ''
         # Age verification.
-        if data[13] and data[18]:
-            if float(data[18]) > float(data[13]):
-                print('Name: %s, Error: Neutering older than current age: %f > %f'
-                      %(data[1], float(data[18]), float(data[13])))
-                data[18] = ''
-        if data[18]:
-            if float(data[18]) < 2:
-                print('Name: %s, Error: Neutering below minimum allowable age: %f < 2 months'
-                      %(data[1], float(data[18])))
-                data[18] = ''
-        if data[13] and data[26]:
-            if float(data[26]) > float(data[13]):
-                print('Name: %s, Error: Onset age older than current age: %f > %f'
-                      %(data[1], float(data[26]), float(data[13])))
-                data[26] = ''
-
-
-    def __verify_data(self):
-        """Verify the recorded dog entry data."""
-        if len(self.__data) < 135:
-            self.__data.insert(133, 0)
+        if data[CURRENT_AGE] and data[NEUTERED_AGE]:
+            if float(data[NEUTERED_AGE]) > float(data[CURRENT_AGE]):
+                # Neutering older than current age.
+                METRICS.count('age_check_rejections', 'neutered_after_current')
+                data[NEUTERED_AGE] = ''
+        if data[NEUTERED_AGE]:
+            if float(data[NEUTERED_AGE]) < 2:
+                # Neutering below minimum allowable age of 2 months.
+                METRICS.count('age_check_rejections', 'neutered_too_young')
+                data[NEUTERED_AGE] = ''
+        if data[CURRENT_AGE] and data[ONSET_AGE]:
+            if float(data[ONSET_AGE]) > float(data[CURRENT_AGE]):
+                # Onset age older than current age.
+                METRICS.count('age_check_rejections', 'onset_after_current')
+                data[ONSET_AGE] = ''
+        record = [uid]
+        record.extend(values)
+        if len(record) <= DOG_WIDTH:
+            # The last dog form lacks a column.
+            record.insert(MISSING_COLUMN + 1, 0)
+        for i, value in data.items():
+            record[i] = value
+        self.__record = schema.convert(record) # the dog data, ready to load
 
     def get_name(self):
         """Return the dog name."""
-        return self.__name
+        return self.__record[1]
 
     def get_data(self):
-        """Return the dog data."""
-        return self.__data
+        """Return the record of the dog data."""
+        return self.__record
 
 
 class UserEntry(object):
 
-    def __init__(self, uid, data):
+    __slots__ = ('__uid', '__ages', '__values', '__schemas', '__user_info',
+                 '__feedback', '__dogs')
+
+    def __init__(self, uid, data, ages, values, schemas):
         """Initialize a UserEntry object."""
-        # demographic status: 10, feedback status: 688 
-        # incomplete: row[10]=0, partial: row[688]=0
+        # incomplete: user status is 0, partial: feedback status is 0
         self.__uid = uid
-        self.__user = data[8]
-        self.__user_info = data[1:11] # start at one to discard redcap ID
-        self.__feedback = data[685:689]
+        self.__ages = ages # parses the dog ages
+        self.__values = values # raw values shared between entries
+        self.__schemas = schemas # converts the records of every table
+        # Discard the redcap ID.
+        self.__user_info = self.__get_record('users', data[USER_INFO_COLUMNS])
+        self.__feedback = self.__get_record('feedback',
+                                            data[FEEDBACK_COLUMNS])
         self.__dogs = []
         self.__update_dogs(data)
 
+    def __share(self, values):
+        """Return the values as a tuple of shared equal values."""
+        return tuple(map(self.__values.setdefault, values, values))
+
+    def __get_record(self, table, values):
+        """Return the converted record of the user's values in a table."""
+        return self.__schemas[table].convert((self.__uid,)
+                                             + self.__share(values))
+
     def __update_dogs(self, data):
         """Update dog data for the user."""
-        dog_cols = [
-            {'start': 11, 'end': 146},
-            {'start': 146, 'end': 281},
-            {'start': 281, 'end': 416},
-            {'start': 416, 'end': 551},
-            {'start': 551, 'end': 685}
-            ]
-        for entry in dog_cols:
+        for start, end in DOG_BLOCKS:
             replacement = False
-            if data[entry['end']-1] == '2': # only record complete dog entries
-                dog_data = data[entry['start']:entry['end']]
+            if data[end-1] == '2': # only record complete dog entries
+                name = data[start].lower()
                 for counter, dog in enumerate(self.__dogs):
-                    if dog.get_name().lower() == dog_data[0].lower():
+                    if dog.get_name().lower() == name:
                         # Update existing data with newest complete submission.
-                        self.__dogs[counter] = DogEntry(self.__uid, dog_data)
+                        METRICS.count('dogs', 'duplicate_replacements')
+                        self.__dogs[counter] = DogEntry(
+                            self.__uid, self.__share(data[start:end]),
+                            self.__ages, self.__schemas['dogs'])
                         replacement = True
                         break
                 if not replacement:
                     # If an entry for the dog does not exist, create one.
-                    self.__dogs.append(DogEntry(self.__uid, dog_data))
+                    self.__dogs.append(DogEntry(
+                        self.__uid, self.__share(data[start:end]),
+                        self.__ages, self.__schemas['dogs']))
 
     def __update_user_info(self, data):
         """Update user info for the user."""
-        if data[10] == '2':
-            self.__user_info = data[1:11]
+        if data[USER_STATUS_COLUMN] == '2':
+            self.__user_info = self.__get_record('users',
+                                                 data[USER_INFO_COLUMNS])
 
     def __update_feedback(self, data):
         """Update feedback for the user."""
-        if data[688] == '2':
-            self.__feedback = data[685:689]
+        if data[FEEDBACK_STATUS_COLUMN] == '2':
+            self.__feedback = self.__get_record('feedback',
+                                                data[FEEDBACK_COLUMNS])
 
     def update(self, data):
         """Update the user with new entry data."""
@@ -434,107 +796,668 @@ class UserEntry(object):
         self.__update_feedback(data)
 
     def get_user_info(self):
-        """Return the user info."""
-        user_info = self.__user_info[:]
-        user_info.insert(0, self.__uid)
-        return user_info
+        """Return the record of the user info."""
+        return self.__user_info
 
     def get_feedback(self):
-        """Return the feedback for the user."""
-        feedback = self.__feedback[:]
-        feedback.insert(0, self.__uid)
-        return feedback
+        """Return the record of the feedback for the user."""
+        return self.__feedback
 
     def get_dogs(self):
         """Return the list of dogs entries for the user."""
         return self.__dogs
 
+    def get_uid(self):
+        """Return the user ID."""
+        return self.__uid
+
 
 class Datastore(object):
 
-    def __init__(self):
+    def __init__(self, ages, schemas, lookup=None, last_uid=0):
         """Initialize the Datastore object."""
         self.__users = {}
-        self.__uid = 0 # user ID
-
-    def __is_valid_entry(self, data):
-        if data[1] == 'redcap_event_name':
-            return False # header
-        elif data[1] == 'event_2_arm_1':
-            return False # phase 2
-        else:
-            return True
+        self.__ages = ages # parses the dog ages
+        self.__schemas = schemas # converts the records of every table
+        self.__lookup = lookup # finds the ID of an already stored user
+        self.__uid = last_uid # user ID
+        self.__values = {} # shared raw values
 
     def add_entry(self, data):
         """Add an entry to the user database."""
-        if self.__is_valid_entry(data):
-            user = data[8]
+        if is_valid_entry(data):
+            user = data[USER_COLUMN]
             if user in self.__users:
                 self.__users[user].update(data)
-            else:
+                return
+            uid = self.__lookup(user) if self.__lookup else None
+            if uid is None:
                 # Increment the uid and add the new entry.
                 self.__uid += 1
-                self.__users[user] = UserEntry(self.__uid, data)
+                uid = self.__uid
+            self.__users[user] = UserEntry(uid, data, self.__ages,
+                                          self.__values, self.__schemas)
 
     def get_users(self):
         """Return the stored user entries."""
         return self.__users
 
+    def get_user_count(self):
+        """Return the number of stored user entries."""
+        return len(self.__users)
+
+    def clear(self):
+        """Forget the stored user entries but keep counting user IDs."""
+        self.__users = {}
+        self.__values = {}
+
+
+class ColumnarStore(object):
+
+    def __init__(self, frame, ages):
+        """Initialize a ColumnarStore object."""
+        self.__ages = ages # parses the dog ages
+        self.__rows = frame.to_numpy(dtype=object)
+        # Skip the phase 2 rows and any repeated header row; the rows are
+        # only indexed, never copied whole.
+        self.__valid = np.flatnonzero(~np.isin(
+            self.__rows[:, EVENT_COLUMN], ['redcap_event_name',
+                                           'event_2_arm_1']))
+        # User IDs follow the order in which the users first appear.
+        codes, _ = pd.factorize(self.__rows[self.__valid, USER_COLUMN])
+        self.__uids = np.zeros(len(self.__rows), dtype=codes.dtype)
+        self.__uids[self.__valid] = codes + 1
+        self.__records = {}
+        self.__parse_users()
+        self.__parse_dogs()
+
+    def __select_rows(self, column):
+        """Return each user's last complete row, or else their first row."""
+        rows = pd.Series(self.__valid)
+        uids = self.__uids[self.__valid]
+        chosen = rows.groupby(uids).first()
+        complete = self.__rows[self.__valid, column] == '2'
+        latest = rows[complete].groupby(uids[complete]).last()
+        chosen[latest.index] = latest
+        return chosen.index.to_numpy().astype(object), chosen.to_numpy()
+
+    def __parse_users(self):
+        """Select the user info and feedback of every user."""
+        uids, rows = self.__select_rows(USER_STATUS_COLUMN)
+        self.__records['users'] = np.column_stack(
+            (uids, self.__rows[rows, USER_INFO_COLUMNS]))
+        uids, rows = self.__select_rows(FEEDBACK_STATUS_COLUMN)
+        self.__records['feedback'] = np.column_stack(
+            (uids, self.__rows[rows, FEEDBACK_COLUMNS]))
+
+    def __parse_dogs(self):
+        """Reshape the dog forms into one row per dog and clean them."""
+        rows = []
+        numbers = []
+        for number, (start, end) in enumerate(DOG_BLOCKS):
+            # Only record complete dog entries.
+            complete = self.__valid[self.__rows[self.__valid, end-1] == '2']
+            rows.append(complete)
+            numbers.append(np.full(len(complete), number))
+        # One entry per dog form, in row then form order. The forms are
+        # only copied out of the rows once the kept ones are known.
+        rows = np.concatenate(rows)
+        numbers = np.concatenate(numbers)
+        order = np.lexsort((numbers, rows))
+        rows = rows[order]
+        numbers = numbers[order]
+        if not len(rows):
+            self.__records['dogs'] = np.empty((0, DOG_WIDTH + 1), dtype=object)
+            return
+        uids = self.__uids[rows]
+        # A dog keeps the position of its first complete submission and
+        # the data of its newest one.
+        entries = pd.DataFrame({'uid': uids,
+                                'name': [name.lower() for name in
+                                         self.__get_column(rows, numbers, 1)],
+                                'position': np.arange(len(rows))})
+        spans = entries.groupby(['uid', 'name'], sort=False)['position']
+        spans = spans.agg(['first', 'last']).reset_index()
+        spans = spans.sort_values(['uid', 'first'])
+        METRICS.count('dogs', 'duplicate_replacements',
+                      len(rows) - len(spans))
+        # Only the cleaned columns go through pandas. Every submission is
+        # cleaned, so the counters match the row engine.
+        data = pd.DataFrame({i: self.__get_column(rows, numbers, i)
+                             for i in CLEANED_COLUMNS}, dtype=object)
+        self.__clean_dogs(data)
+        kept = spans['last'].to_numpy()
+        records = np.empty((len(kept), DOG_WIDTH + 1), dtype=object)
+        records[:, 0] = uids[kept]
+        for number, (start, end) in enumerate(DOG_BLOCKS):
+            out = np.flatnonzero(numbers[kept] == number)
+            block = self.__rows[rows[kept[out]], start:end]
+            if end - start < DOG_WIDTH:
+                records[out, 1:MISSING_COLUMN+1] = block[:, :MISSING_COLUMN]
+                records[out, MISSING_COLUMN+1] = 0
+                records[out, MISSING_COLUMN+2:] = block[:, MISSING_COLUMN:]
+            else:
+                records[out, 1:] = block
+        records[:, CLEANED_COLUMNS] = data.to_numpy(dtype=object)[kept]
+        self.__records['dogs'] = records
+
+    def __get_column(self, rows, numbers, column):
+        """Return a dog data column of the dog forms in the given rows."""
+        index = column - 1 # the dog data starts with the user ID
+        columns = np.array([start + index
+                            - (end - start < DOG_WIDTH
+                               and index > MISSING_COLUMN)
+                            for start, end in DOG_BLOCKS])
+        values = self.__rows[rows, columns[numbers]]
+        if index == MISSING_COLUMN:
+            # The last dog form lacks the column.
+            short = [number for number, (start, end) in enumerate(DOG_BLOCKS)
+                     if end - start < DOG_WIDTH]
+            values[np.isin(numbers, short)] = 0
+        return values
+
+    def __clean_dogs(self, data):
+        """Apply the DogEntry conversions to whole columns."""
+        # Convert breed reference index to breed.
+        breeds = data[BREED_COLUMN] != ''
+        data.loc[breeds, BREED_COLUMN] = data.loc[breeds, BREED_COLUMN].map(
+            lambda code: BREED_REFERENCE[code])
+        # Simplify acquisition source.
+        data.loc[data[SOURCE_COLUMN] == '4', SOURCE_COLUMN] = '1'
+        # Convert the current, neutered and onset ages to months.
+        for months, years in AGE_COLUMNS:
+            in_months = data[months] != ''
+            in_years = ~in_months & (data[years] != '')
+            data.loc[in_months, months] = parse_column(
+                data.loc[in_months, months], 'm', self.__ages)
+            data.loc[in_years, months] = parse_column(
+                data.loc[in_years, years], 'y', self.__ages)
+            data.loc[in_years, years] = ''
+        # Age verification.
+        current = pd.to_numeric(data[CURRENT_AGE], errors='coerce')
+        neutered = pd.to_numeric(data[NEUTERED_AGE], errors='coerce')
+        invalid = neutered > current
+        METRICS.count('age_check_rejections', 'neutered_after_current',
+                      int(invalid.sum()))
+        data.loc[invalid, NEUTERED_AGE] = ''
+        neutered[invalid] = np.nan
+        invalid = neutered < 2
+        METRICS.count('age_check_rejections', 'neutered_too_young',
+                      int(invalid.sum()))
+        data.loc[invalid, NEUTERED_AGE] = ''
+        onset = pd.to_numeric(data[ONSET_AGE], errors='coerce')
+        invalid = onset > current
+        METRICS.count('age_check_rejections', 'onset_after_current',
+                      int(invalid.sum()))
+        data.loc[invalid, ONSET_AGE] = ''
+
+    def get_records(self):
+        """Return the user info, feedback and dog records of every table."""
+        return self.__records
+
 
 class DatabaseModifier(object):
 
-    def __init__(self):
+    def __init__(self, record_ids=None):
         """Initialize a DatabaseModifier object."""
         self.__conn = sqlite3.connect(processed_filepath)
         self.__cursor = self.__conn.cursor()
-        self.__modifySoilTypes()
+        self.__record_ids = record_ids # only modify these users' dogs
+        self.__expandFields(EXPANDED_FIELDS)
 
-    def __getValues(self, field):
-        query = 'SELECT record_id, dog_name, %s FROM dogs;' %(field)
-        self.__cursor.execute(query)
-        return self.__cursor.fetchall()
+    def __del__(self):
+        """Destructor for the DatabaseModifier object."""
+        self.__conn.close()
 
     def __addColumn(self, field):
-        query = 'ALTER TABLE dogs ADD COLUMN %s TEXT DEFAULT 0;' %(field)
+        self.__cursor.execute('PRAGMA table_info(dogs);')
+        if field in [row[1] for row in self.__cursor.fetchall()]:
+            return
+        query = 'ALTER TABLE dogs ADD COLUMN %s INTEGER DEFAULT 0;' %(field)
         self.__cursor.execute(query)
 
-    def __addValue(self, record_id, dog_name, field, value):
-        query = ('UPDATE dogs SET  %s=%s WHERE record_id=%s AND dog_name="%s";'
-                 %(field, value, record_id, dog_name))
+    def __expandFields(self, fields):
+        """Set the indicator columns of every field in one pass."""
+        assignments = []
+        codes = []
+        for field in fields:
+            for code in DICTIONARY.get_field(field)['choices']:
+                column = '%s_%s' %(field, code)
+                self.__addColumn(column)
+                assignments.append('%s=CASE %s WHEN ? THEN 1 ELSE 0 END'
+                                   %(column, field))
+                codes.append(to_integer(code))
+        query = 'UPDATE dogs SET %s' %', '.join(assignments)
+        if self.__record_ids is None:
+            self.__cursor.execute(query + ';', codes)
+        else:
+            for chunk in chunked(self.__record_ids, SQL_VARIABLE_LIMIT):
+                self.__cursor.execute('%s WHERE record_id IN (%s);'
+                                      %(query, ', '.join('?' * len(chunk))),
+                                      codes + chunk)
+        self.__conn.commit()
+
+
+class DatabaseIndexer(object):
+
+    def __init__(self):
+        """Initialize a DatabaseIndexer object."""
+        self.__conn = sqlite3.connect(processed_filepath)
+        self.__cursor = self.__conn.cursor()
+
+    def __del__(self):
+        """Destructor for the DatabaseIndexer object."""
+        self.__conn.close()
+
+    def create_indexes(self):
+        """Index the join keys and the bias filter columns."""
+        for table, columns in INDEXES:
+            name = '%s_%s' %(table, '_'.join(columns))
+            query = ('CREATE INDEX IF NOT EXISTS %s ON %s (%s);'
+                     %(name, table, ', '.join(columns)))
+            self.__cursor.execute(query)
+        self.__conn.commit()
+
+    def analyze(self):
+        """Gather statistics for the query planner."""
+        self.__cursor.execute('ANALYZE;')
+        self.__conn.commit()
+
+    def __get_columns(self, query):
+        """Return the column names of a query's result."""
+        self.__cursor.execute('SELECT * FROM %s LIMIT 0;' %query)
+        return [column[0] for column in self.__cursor.description]
+
+    def update_adjusted_dogs(self, record_ids):
+        """Refresh the adjusted dogs of the provided users."""
+        columns = self.__get_columns('dogs JOIN users USING (record_id)')
+        if columns != self.__get_columns('dogs_adjusted'):
+            # The tables gained columns, so the view is rebuilt instead.
+            self.create_adjusted_dogs()
+            return
+        columns = ', '.join(columns)
+        for chunk in chunked(record_ids, SQL_VARIABLE_LIMIT):
+            placeholders = ', '.join('?' * len(chunk))
+            self.__cursor.execute('DELETE FROM dogs_adjusted '
+                                  'WHERE record_id IN (%s);' %placeholders,
+                                  chunk)
+            query = ('INSERT INTO dogs_adjusted (%s) SELECT %s FROM dogs '
+                     'JOIN users USING (record_id) '
+                     'WHERE record_id IN (%s) AND (%s);'
+                     %(columns, columns, placeholders, BIAS_FILTER))
+            self.__cursor.execute(query, chunk)
+        self.__conn.commit()
+
+    def create_adjusted_dogs(self):
+        """Materialize the bias-filtered dogs joined to their users."""
+        self.__cursor.execute('DROP TABLE IF EXISTS dogs_adjusted;')
+        query = ('CREATE TABLE dogs_adjusted AS SELECT * FROM dogs '
+                 'JOIN users USING (record_id) WHERE %s;' %BIAS_FILTER)
         self.__cursor.execute(query)
+        self.__cursor.execute('CREATE INDEX dogs_adjusted_record_id '
+                              'ON dogs_adjusted (record_id);')
+        self.__conn.commit()
 
-    def __modifySoilTypes(self):
-        field = 'q06_soil_type'
-        values = self.__getValues(field)
-        for i in range(1, 4):
-            self.__addColumn(field + '_%s'%i)
-        for pair in values:
-            if pair[2]:
-                self.__addValue(pair[0], pair[1], field + '_%s'%pair[2], 1)
+
+class CountryLocator(object):
+
+    def __init__(self, translator, record_ids=None):
+        """Initialize a CountryLocator object."""
+        self.__conn = sqlite3.connect(processed_filepath)
+        self.__cursor = self.__conn.cursor()
+        self.__translator = translator
+        self.__record_ids = record_ids # only locate these users
+        if self.__addColumns():
+            # Users of an older build have no postal columns yet.
+            self.__record_ids = None
+
+    def __del__(self):
+        """Destructor for the CountryLocator object."""
+        self.__conn.close()
+
+    def __addColumns(self):
+        """Add the missing postal columns, returning whether any were."""
+        columns = datadict.get_declared_types(self.__conn, 'users')
+        added = False
+        for column, sql_type, indexed in POSTAL_COLUMNS:
+            if column not in columns:
+                self.__cursor.execute('ALTER TABLE users ADD COLUMN %s %s;'
+                                      %(column, sql_type))
+                added = True
+            if indexed:
+                self.__cursor.execute('CREATE INDEX IF NOT EXISTS users_%s '
+                                      'ON users (%s);' %(column, column))
+        return added
+
+    def __read_users(self):
+        """Return the zip code of every user to locate."""
+        query = 'SELECT record_id, zip_code FROM users'
+        if self.__record_ids is None:
+            return pd.read_sql_query(query + ';', self.__conn)
+        frames = [pd.read_sql_query('%s WHERE record_id IN (%s);'
+                                    %(query, ', '.join('?' * len(chunk))),
+                                    self.__conn, params=chunk)
+                  for chunk in chunked(self.__record_ids, SQL_VARIABLE_LIMIT)]
+        if not frames:
+            return pd.DataFrame(columns=['record_id', 'zip_code'])
+        return pd.concat(frames, ignore_index=True)
+
+    def get_record_ids(self):
+        """Return the IDs of the users located, or None for every user."""
+        return self.__record_ids
+
+    def locate(self):
+        """Store the postal code and country of the users in one pass."""
+        users = self.__read_users()
+        users['zip_code'] = users['zip_code'].fillna('').astype(str)
+        codes = self.__translator.translate(users['zip_code'])
+        codes['postal_countries'] = codes['candidates'].str.join(',')
+        users = users.join(codes.set_index('zip_code'), on='zip_code')
+        confidences = users['confidence'].astype(object)
+        confidences = confidences.where(confidences.notnull(), None)
+        self.__cursor.executemany('UPDATE users SET postal_code=?, '
+                                  'postal_countries=?, country=?, '
+                                  'postal_confidence=? WHERE record_id=?;',
+                                  zip(users['key'].tolist(),
+                                      users['postal_countries'].tolist(),
+                                      users['translation'].tolist(),
+                                      confidences.tolist(),
+                                      users['record_id'].tolist()))
         self.__conn.commit()
+        return len(users)
 
 
-def main():
+def locate_users(record_ids=None, api_url=None, dump_path=None):
+    """Resolve the country of the users, online only if given an API URL.
+
+    Returns the IDs of the users located, or None if every user was.
+    """
+    logger = logging.getLogger(__name__)
+    METRICS.start('locate')
+    index = postal_index.load_index(dump_path or postal_index.source_filepath)
+    recovery = None
+    if index is None:
+        if api_url:
+            logger.warning('no postal index or dump at %s, looking every '
+                           'postal code up with %s',
+                           dump_path or postal_index.source_filepath, api_url)
+        else:
+            logger.warning('no postal index or dump at %s, leaving postal '
+                           'codes unidentified; see --postal-dump and '
+                           '--online-postal',
+                           dump_path or postal_index.source_filepath)
+    else:
+        recovery = postal_recovery.PostalRecovery(index)
+    resolver = None
+    if api_url:
+        resolver = postal_index.PostalResolver(api_url)
+    cache = postal_index.PostalCache(postal_cache_filepath)
+    translator = postal_index.PostalTranslator(index, resolver, cache,
+                                               recovery)
+    locator = CountryLocator(translator, record_ids)
+    count = locator.locate()
+    cache.flush()
+    counts = cache.get_counts()
+    logger.info('postal cache: %(hits)d hits, %(misses)d misses, '
+                '%(expired)d expired', counts)
+    METRICS.set_section('postal_cache', counts)
+    if recovery is not None:
+        counts = recovery.get_counts()
+        logger.info('recovered %d of %d unidentified postal codes',
+                    counts['repaired'] + counts['matched'],
+                    counts['attempted'])
+        METRICS.set_section('postal_recovery', counts)
+    METRICS.stop(count)
+    return locator.get_record_ids()
+
+
+def partition_rows(rows, paths):
+    """Split the rows by user into shard files and assign the user IDs."""
+    rows = iter(rows)
+    header = next(rows)
+    files = [open(path, 'w', newline='') for path in paths]
+    try:
+        writers = [csv.writer(fout) for fout in files]
+        for writer in writers:
+            writer.writerow(header)
+        uids = [{} for path in paths]
+        shards = {}
+        count = 0
+        for row in rows:
+            count += 1
+            if not is_valid_entry(row):
+                continue
+            user = row[USER_COLUMN]
+            shard = shards.get(user)
+            if shard is None:
+                # Users are numbered in order of appearance, like Datastore.
+                uid = len(shards) + 1
+                shard = shards[user] = uid % len(paths)
+                uids[shard][user] = uid
+            writers[shard].writerow(row)
+    finally:
+        for fout in files:
+            fout.close()
+    return header, uids, count
+
+
+def init_worker():
+    """Prepare a worker process to build shards."""
+    profiling.reset() # workers are profiled apart from the parent
+
+
+def build_shard(rows_path, db_path, uids):
+    """Build the tables of one shard of users in its own database."""
+    global METRICS
+    METRICS = run_metrics.Metrics() # counters of this shard only
+    with profiling.stage('shard'):
+        with open(rows_path, 'r', newline='') as fin:
+            manager = Manager(csv.reader(fin, delimiter=','), path=db_path,
+                              lookup=uids.get)
+        manager.create_tables()
+        manager.populate_tables()
+    return (manager.get_age_counts(), manager.get_age_failures(),
+            METRICS.get_counters())
+
+
+def build_sharded(rows, workers):
+    """Build the tables in worker processes and merge them."""
+    logger = logging.getLogger(__name__)
+    shard_dir = tempfile.mkdtemp(dir=os.path.dirname(processed_filepath))
+    try:
+        rows_paths = [os.path.join(shard_dir, 'shard_%d.csv' %i)
+                      for i in range(workers)]
+        db_paths = [os.path.join(shard_dir, 'shard_%d.db' %i)
+                    for i in range(workers)]
+        logger.info('partitioning users into %d shards', workers)
+        METRICS.start('partition')
+        header, uids, count = partition_rows(rows, rows_paths)
+        METRICS.stop(count)
+        logger.info('building the shards')
+        METRICS.start('shards')
+        with ProcessPoolExecutor(workers, initializer=init_worker) as executor:
+            results = list(executor.map(build_shard, rows_paths, db_paths,
+                                        uids))
+        METRICS.stop(count)
+        logger.info('merging the shards')
+        METRICS.start('merge')
+        manager = Manager([header])
+        manager.create_tables()
+        manager.merge_shards(db_paths)
+        for counts, failures, counters in results:
+            manager.add_age_counts(counts, failures)
+            METRICS.add_counters(counters)
+        METRICS.stop()
+    finally:
+        shutil.rmtree(shard_dir)
+    return manager
+
+
+def build(rows, batch_size=None, columnar=False, workers=None,
+          postal_api_url=None, postal_dump=None, parquet=False):
+    """Build the processed dataset from scratch."""
+    logger = logging.getLogger(__name__)
+    # Later runs start from the compiled dictionary.
+    DICTIONARY.save()
+    if workers:
+        manager = build_sharded(rows, workers)
+        indexer = DatabaseIndexer()
+        logger.info('indexing database')
+        METRICS.start('index')
+        indexer.create_indexes()
+    else:
+        METRICS.start('parse')
+        manager = Manager(rows, batch_size=batch_size, columnar=columnar)
+        METRICS.stop(None if batch_size else manager.get_row_count())
+        logger.info('creating tables')
+        manager.create_tables()
+        indexer = DatabaseIndexer()
+        if batch_size:
+            # Later submissions are merged through indexed lookups.
+            logger.info('indexing database')
+            indexer.create_indexes()
+            logger.info('streaming the database in batches of %d users',
+                        batch_size)
+            METRICS.start('stream')
+            manager.stream_tables()
+            METRICS.stop(manager.get_row_count())
+        else:
+            logger.info('populating the database')
+            METRICS.start('load')
+            manager.populate_tables()
+            METRICS.stop(manager.get_row_count())
+            logger.info('indexing database')
+            METRICS.start('index')
+            indexer.create_indexes()
+    indexer.analyze()
+    METRICS.stop()
+    logger.info('age cache: %(memory_hits)d memory hits, %(table_hits)d '
+                'table hits, %(misses)d misses', manager.get_age_counts())
+
+    logger.info('modifying database')
+    METRICS.start('modify')
+    modifier = DatabaseModifier()
+
+    logger.info('locating users')
+    locate_users(api_url=postal_api_url, dump_path=postal_dump)
+
+    logger.info('materializing adjusted dogs')
+    METRICS.start('materialize')
+    indexer.create_adjusted_dogs()
+
+    export_parquet(parquet)
+    METRICS.stop()
+    logger.info('recording metrics')
+    manager.write_metrics()
+
+
+def select_user_rows(rows, users):
+    """Yield the header and the rows of the provided users."""
+    rows = iter(rows)
+    yield next(rows)
+    for row in rows:
+        if row[USER_COLUMN] in users:
+            yield row
+
+
+def update(rows, postal_api_url=None, postal_dump=None, parquet=False):
+    """Rebuild the users of the changed records in the processed dataset."""
+    logger = logging.getLogger(__name__)
+    # Later runs start from the compiled dictionary.
+    DICTIONARY.save()
+    users = {row[USER_COLUMN] for row in rows if is_valid_entry(row)}
+    METRICS.start('parse')
+    # Changed users are rebuilt from all of their rows, as a full build
+    # would, since a change may replace a row an earlier one overrode.
+    with open(get_data_file(), 'r') as fin:
+        manager = Manager(select_user_rows(csv.reader(fin, delimiter=','),
+                                           users),
+                          incremental=True)
+    METRICS.stop(manager.get_row_count())
+    logger.info('replacing %d changed users', len(users))
+    METRICS.start('replace')
+    record_ids = manager.replace_tables()
+    METRICS.stop(manager.get_row_count())
+    logger.info('age cache: %(memory_hits)d memory hits, %(table_hits)d '
+                'table hits, %(misses)d misses', manager.get_age_counts())
+
+    logger.info('modifying %d updated users', len(record_ids))
+    METRICS.start('modify')
+    modifier = DatabaseModifier(record_ids)
+
+    logger.info('locating %d updated users', len(record_ids))
+    located = locate_users(record_ids, postal_api_url, postal_dump)
+
+    METRICS.start('materialize')
+    indexer = DatabaseIndexer()
+    if located is None:
+        # Every user gained the postal columns.
+        logger.info('materializing adjusted dogs')
+        indexer.create_adjusted_dogs()
+    else:
+        logger.info('refreshing adjusted dogs')
+        indexer.update_adjusted_dogs(record_ids)
+
+    export_parquet(parquet)
+    METRICS.stop()
+    logger.info('recording metrics')
+    manager.write_metrics()
+
+
+def main(pipeline=False, write_raw=False, batch_size=None, incremental=False,
+         user_batch_size=None, columnar=False, workers=None,
+         postal_api_url=None, postal_dump=None, parquet=False):
     """
     Runs data processing scripts to turn raw data from (../raw) into
     cleaned data ready to be analyzed (saved in ../processed).
     """
     logger = logging.getLogger(__name__)
 
+    if incremental and os.path.exists(processed_filepath):
+        if not os.path.isfile(delta_filepath):
+            logger.info('no changed records to apply')
+            return
+        with open(delta_filepath, 'r') as fin:
+            update(csv.reader(fin, delimiter=','), postal_api_url,
+                   postal_dump, parquet)
+        os.remove(delta_filepath)
+        logger.info('dataset update complete')
+        return
+
     if os.path.exists(processed_filepath):
+        # The ages are parsed again, so that parser changes reach them all.
         logger.info('remove existing processed dataset')
         os.remove(processed_filepath)
 
-    manager = Manager(get_data_file())
-    logger.info('creating tables')
-    manager.create_tables()
-    logger.info('populating the database')
-    manager.populate_tables()
-    logger.info('recording metrics')
-    manager.write_metrics()
-
-    logger.info('modifying database')
-    modifier = DatabaseModifier()
+    if pipeline:
+        logger.info('loading rows while they are fetched from REDCap')
+        side_output = raw_filepath if write_raw else None
+        rows = RowPipeline(fetch_rows(batch_size), side_output)
+        if columnar:
+            METRICS.start('read')
+            rows = read_columns(rows)
+            METRICS.stop(len(rows) - 1)
+            build(rows, columnar=True, postal_api_url=postal_api_url,
+                  postal_dump=postal_dump, parquet=parquet)
+        else:
+            build(rows, user_batch_size, workers=workers,
+                  postal_api_url=postal_api_url, postal_dump=postal_dump,
+                  parquet=parquet)
+    elif columnar:
+        logger.info('reading the raw data as columns')
+        METRICS.start('read')
+        rows = read_columns(get_data_file())
+        METRICS.stop(len(rows) - 1)
+        build(rows, columnar=True, postal_api_url=postal_api_url,
+              postal_dump=postal_dump, parquet=parquet)
+    else:
+        with open(get_data_file(), 'r') as fin:
+            build(csv.reader(fin, delimiter=','), user_batch_size,
+                  workers=workers, postal_api_url=postal_api_url,
+                  postal_dump=postal_dump, parquet=parquet)
+    # A full build already includes any pending changes.
+    if os.path.isfile(delta_filepath):
+        os.remove(delta_filepath)
 
     logger.info('dataset generation complete')
 
@@ -543,16 +1466,61 @@ if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
 
-    # store necessary paths and variables
-    project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
-    data_dir = os.path.join(project_dir, 'data')
-    raw_filepath = os.path.join(data_dir, 'raw', 'raw.csv')
-    processed_filepath = os.path.join(data_dir, 'processed', 'processed.db')
-    metrics_filepath = os.path.join(data_dir, 'processed', 'metrics.log')
-    data_dictionary = os.path.join(project_dir, 'docs', 'data_dictionary.csv')
-    BREED_REFERENCE=get_breed_dict()
-
-    main()
+    parser = argparse.ArgumentParser(
+        description='Build the processed dataset.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='rebuild the users of the records changed '
+                             'since the last build from data/raw/delta.csv')
+    parser.add_argument('--user-batch-size', type=int, default=None,
+                        help='stream the rows into the database, flushing '
+                             'every this many users to bound memory')
+    parser.add_argument('--columnar', action='store_true',
+                        help='build the tables with vectorized column '
+                             'operations instead of per-row entries')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='build shards of users in this many processes '
+                             'and merge them')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='fetch, scrub and load in one pass instead of '
+                             'reading data/raw/raw.csv')
+    parser.add_argument('--write-raw', action='store_true',
+                        help='with --pipeline, also save the scrubbed rows '
+                             'to data/raw/raw.csv')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='with --pipeline, fetch this many records per '
+                             'request')
+    parser.add_argument('--online-postal', action='store_true',
+                        help='look up postal codes missing from the offline '
+                             'index with the postal code API')
+    parser.add_argument('--postal-api-url', default=None,
+                        help='with --online-postal, base URL of the postal '
+                             'code API (default: %s)' %postal_index.API_URL)
+    parser.add_argument('--postal-dump', default=postal_index.source_filepath,
+                        help='GeoNames postal code dump to index offline, '
+                             'e.g. allCountries.zip; without it, postal '
+                             'codes are only resolved with --online-postal '
+                             '(default: data/external/allCountries.zip)')
+    parser.add_argument('--parquet', action='store_true',
+                        help='also export the tables as Parquet files beside '
+                             'the database')
+    args = parser.parse_args()
+    if args.columnar and args.user_batch_size:
+        parser.error('--columnar reads all rows at once and cannot be '
+                     'combined with --user-batch-size')
+    if args.workers and (args.columnar or args.user_batch_size):
+        parser.error('--workers cannot be combined with --columnar or '
+                     '--user-batch-size')
+    if args.postal_api_url and not args.online_postal:
+        parser.error('--postal-api-url requires --online-postal')
+    if (args.postal_dump != postal_index.source_filepath
+            and not os.path.isfile(args.postal_dump)):
+        parser.error('no postal dump at %s' %args.postal_dump)
+
+    main(args.pipeline, args.write_raw, args.batch_size, args.incremental,
+         args.user_batch_size, args.columnar, args.workers,
+         (args.postal_api_url or postal_index.API_URL)
+         if args.online_postal else None,
+         args.postal_dump, args.parquet)
 
 """
 FILTER CRITERIA
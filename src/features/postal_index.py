@@ -0,0 +1,449 @@
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import csv
+import io
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zipfile
+
+import pandas as pd
+
+# store necessary paths and variables
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+data_dir = os.path.join(project_dir, 'data')
+# GeoNames postal code dump, e.g. allCountries.zip from
+# https://download.geonames.org/export/zip/
+source_filepath = os.path.join(data_dir, 'external', 'allCountries.zip')
+index_filepath = os.path.join(data_dir, 'interim', 'postal_index.db')
+INSERT_BATCH_SIZE = 50000 # postal codes per executemany call
+API_URL = 'http://api.zippopotam.us/'
+# Seconds that cached translations and failed lookups stay valid.
+FOUND_TTL = 180 * 24 * 3600
+FAILED_TTL = 7 * 24 * 3600
+# Translations kept in the persistent cache; the least recently used go.
+CACHE_SIZE = 100000
+RESOLVER_WORKERS = 32 # concurrent postal code lookups
+HOST_LIMIT = 8 # requests in flight per API host
+REQUEST_TIMEOUT = 10 # seconds
+RETRIES = 3 # attempts after a failed connection or a transient error
+RETRY_BACKOFF = 0.5 # seconds, doubled on every retry
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+# Country names by ISO code, as reported by the zippopotam.us API.
+COUNTRY_NAMES = {
+    'ar': 'Argentina',
+    'at': 'Austria',
+    'au': 'Australia',
+    'bd': 'Bangladesh',
+    'be': 'Belgium',
+    'bg': 'Bulgaria',
+    'ca': 'Canada',
+    'ch': 'Switzerland',
+    'de': 'Germany',
+    'dk': 'Denmark',
+    'do': 'Dominican Republic',
+    'es': 'Spain',
+    'fi': 'Finland',
+    'fr': 'France',
+    'gb': 'Great Britain',
+    'in': 'India',
+    'it': 'Italy',
+    'mx': 'Mexico',
+    'pl': 'Poland',
+    'pt': 'Portugal',
+    'ru': 'Russia',
+    'us': 'United States'
+    }
+# Countries whose postal codes are only matched on their leading characters.
+PREFIX_LENGTHS = {
+    'ca': 3,
+    'gb': 3,
+    'us': 5
+    }
+# Translations of codes that are missing or could not be resolved.
+NOT_PROVIDED = 'Not Provided'
+NOT_IDENTIFIED = 'Not Identified'
+# Postal code formats, in order of priority, and the countries using them.
+POSTAL_FORMATS = [
+    # US, Germany, Mexico, Dominican Republic, Spain, Finland, France, Italy
+    ('five_digit', '[0-9]{5}(?:-[0-9]{4})?',
+     ['us', 'de', 'mx', 'do', 'es', 'fi', 'fr', 'it']),
+    # Canada
+    ('canada', '(?:[A-Z][0-9]){3}', ['ca']),
+    # UK
+    ('uk', '[A-Z]{1,2}[0-9]{1,3}[A-Z]{0,2}', ['gb']),
+    # Australia, Belgium, Austria, Argentina, Bangladesh, Bulgaria,
+    # Switzerland, Denmark
+    ('four_digit', '[0-9]{4}',
+     ['au', 'be', 'at', 'ar', 'bd', 'bg', 'ch', 'dk']),
+    # Russia, India
+    ('six_digit', '[0-9]{6}', ['ru', 'in']),
+    # Poland
+    ('poland', '[0-9]{2}-[0-9]{3}', ['pl']),
+    # Portugal
+    ('portugal', '[0-9]{4}-[0-9]{3}', ['pt'])
+    ]
+# All formats as one pattern; the first alternative that matches names the
+# format.
+POSTAL_PATTERN = re.compile('^(?:%s)$' %'|'.join(
+    '(?P<%s>%s)' %(name, pattern) for name, pattern, _ in POSTAL_FORMATS))
+FORMAT_COUNTRIES = {name: countries for name, _, countries in POSTAL_FORMATS}
+
+
+def normalize(code, country):
+    """Return a postal code in the form it is indexed under."""
+    code = code.replace(' ', '').upper()
+    if country in PREFIX_LENGTHS:
+        code = code[:PREFIX_LENGTHS[country]]
+    return code
+
+
+def classify(zip_codes):
+    """Return the normalized code and candidate countries of distinct codes."""
+    codes = pd.Series(pd.Series(zip_codes, dtype=object).unique(),
+                      dtype=object)
+    # Remove whitespace and homogenize type case.
+    normalized = codes.str.replace(' ', '', regex=False).str.upper()
+    matches = normalized.str.extract(POSTAL_PATTERN).notnull()
+    formats = matches.idxmax(axis=1).where(matches.any(axis=1))
+    keys = normalized.copy()
+    for name, countries in FORMAT_COUNTRIES.items():
+        # Only the prefix of some codes is looked up.
+        length = next((PREFIX_LENGTHS[country] for country in countries
+                       if country in PREFIX_LENGTHS), None)
+        if length:
+            in_format = formats == name
+            keys[in_format] = normalized[in_format].str[:length]
+    candidates = [FORMAT_COUNTRIES.get(name, []) for name in formats]
+    return pd.DataFrame({'zip_code': codes, 'key': keys,
+                         'candidates': candidates})
+
+
+def read_geonames(path):
+    """Yield the country and postal code of every GeoNames entry."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            # The dump is the only text file besides the readme.
+            name = [name for name in archive.namelist()
+                    if name.endswith('.txt')
+                    and os.path.basename(name).lower() != 'readme.txt'][0]
+            with archive.open(name) as fin:
+                text = io.TextIOWrapper(fin, encoding='utf-8', newline='')
+                for row in csv.reader(text, delimiter='\t',
+                                      quoting=csv.QUOTE_NONE):
+                    yield row[0].lower(), row[1]
+    else:
+        with open(path, newline='', encoding='utf-8') as fin:
+            for row in csv.reader(fin, delimiter='\t',
+                                  quoting=csv.QUOTE_NONE):
+                yield row[0].lower(), row[1]
+
+
+def build_index(source, path, countries=COUNTRY_NAMES):
+    """Build the postal index database from a GeoNames dump."""
+    temp_path = path + '.part'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    conn = sqlite3.connect(temp_path)
+    try:
+        conn.execute('CREATE TABLE postal_codes (code TEXT, country TEXT, '
+                     'PRIMARY KEY (code, country)) WITHOUT ROWID;')
+        batch = []
+        for country, code in read_geonames(source):
+            if country in countries:
+                batch.append((normalize(code, country), country))
+            if len(batch) >= INSERT_BATCH_SIZE:
+                conn.executemany('INSERT OR IGNORE INTO postal_codes '
+                                 'VALUES (?, ?);', batch)
+                batch = []
+        conn.executemany('INSERT OR IGNORE INTO postal_codes '
+                         'VALUES (?, ?);', batch)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(temp_path, path)
+
+
+def load_index(source=source_filepath, path=index_filepath):
+    """Return the postal index, building it when the dump is newer."""
+    logger = logging.getLogger(__name__)
+    if os.path.exists(source):
+        if (not os.path.exists(path)
+                or os.path.getmtime(path) < os.path.getmtime(source)):
+            logger.info('building the postal index from %s', source)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            build_index(source, path)
+    if not os.path.exists(path):
+        return None
+    return PostalIndex(path)
+
+
+class PostalIndex(object):
+
+    def __init__(self, path):
+        """Initialize a PostalIndex object."""
+        self.__conn = sqlite3.connect(path)
+        self.__countries = {} # indexed countries of the codes looked up
+
+    def __del__(self):
+        """Destructor for the PostalIndex object."""
+        self.__conn.close()
+
+    def __get_countries(self, code):
+        """Return the countries in which a normalized code exists."""
+        countries = self.__countries.get(code)
+        if countries is None:
+            rows = self.__conn.execute('SELECT country FROM postal_codes '
+                                       'WHERE code=?;', (code,)).fetchall()
+            countries = self.__countries[code] = frozenset(
+                row[0] for row in rows)
+        return countries
+
+    def get_codes(self, country):
+        """Return the normalized codes indexed for a country."""
+        rows = self.__conn.execute('SELECT code FROM postal_codes '
+                                   'WHERE country=?;', (country,))
+        return [row[0] for row in rows]
+
+    def get_country(self, code, candidates):
+        """Return the name of the first candidate country with the code."""
+        for country in candidates:
+            if country in self.__get_countries(normalize(code, country)):
+                return COUNTRY_NAMES.get(country, country.upper())
+        return None
+
+
+class PostalCache(object):
+
+    def __init__(self, path, found_ttl=FOUND_TTL, failed_ttl=FAILED_TTL,
+                 size=CACHE_SIZE):
+        """Initialize a PostalCache object."""
+        self.__conn = sqlite3.connect(path)
+        self.__ttls = {True: found_ttl, False: failed_ttl}
+        self.__size = size # translations kept
+        self.__used = {} # last use of the cached codes that were hit
+        self.__pending = [] # translations not yet stored
+        self.__counts = {'hits': 0, 'misses': 0, 'expired': 0}
+        self.__conn.execute('CREATE TABLE IF NOT EXISTS postal_cache '
+                            '(code TEXT PRIMARY KEY, translation TEXT, '
+                            'found INTEGER, resolved REAL, used REAL);')
+
+    def __del__(self):
+        """Destructor for the PostalCache object."""
+        self.__conn.close()
+
+    def get(self, code):
+        """Return the cached translation of a code, if still valid."""
+        row = self.__conn.execute('SELECT translation, found, resolved '
+                                  'FROM postal_cache WHERE code=?;',
+                                  (code,)).fetchone()
+        now = time.time()
+        if row is None:
+            self.__counts['misses'] += 1
+            return None
+        translation, found, resolved = row
+        if now - resolved > self.__ttls[bool(found)]:
+            self.__counts['expired'] += 1
+            return None
+        self.__counts['hits'] += 1
+        self.__used[code] = now
+        return translation
+
+    def put(self, code, translation, found):
+        """Cache the translation of a code."""
+        now = time.time()
+        self.__pending.append((code, translation, int(found), now, now))
+
+    def flush(self):
+        """Store the new translations and evict the least recently used."""
+        self.__conn.executemany('UPDATE postal_cache SET used=? '
+                                'WHERE code=?;',
+                                [(used, code)
+                                 for code, used in self.__used.items()])
+        self.__conn.executemany('INSERT OR REPLACE INTO postal_cache '
+                                'VALUES (?, ?, ?, ?, ?);', self.__pending)
+        self.__conn.execute('DELETE FROM postal_cache WHERE code IN '
+                            '(SELECT code FROM postal_cache '
+                            'ORDER BY used DESC LIMIT -1 OFFSET ?);',
+                            (self.__size,))
+        self.__conn.commit()
+        self.__used = {}
+        self.__pending = []
+
+    def get_counts(self):
+        """Return the cache hit, miss and expiry counters."""
+        return dict(self.__counts)
+
+
+class PostalResolver(object):
+
+    def __init__(self, api_url=API_URL, workers=RESOLVER_WORKERS,
+                 host_limit=HOST_LIMIT):
+        """Initialize a PostalResolver object."""
+        self.__api_url = api_url
+        self.__workers = workers
+        self.__host_limit = host_limit
+        self.__hosts = {} # request slots of every host
+        self.__lock = threading.Lock()
+        # Only online lookups need requests.
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        self.__errors = (requests.RequestException, ValueError)
+        # Keep-alive connections, retried with exponential backoff.
+        retry = Retry(total=RETRIES, backoff_factor=RETRY_BACKOFF,
+                      status_forcelist=RETRY_STATUSES)
+        adapter = HTTPAdapter(pool_maxsize=host_limit, max_retries=retry)
+        self.__session = requests.Session()
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+
+    def __get_slots(self, url):
+        """Return the semaphore bounding the requests to a URL's host."""
+        host = urllib.parse.urlsplit(url).netloc
+        with self.__lock:
+            if host not in self.__hosts:
+                self.__hosts[host] = threading.BoundedSemaphore(
+                    self.__host_limit)
+            return self.__hosts[host]
+
+    def __fetch(self, country, zip_code):
+        """Return the country reported for a code, '' if it does not exist
+        there or None if the API did not answer."""
+        url = self.__api_url + country + '/' + zip_code
+        with self.__get_slots(url):
+            try:
+                response = self.__session.get(url, timeout=REQUEST_TIMEOUT)
+                data = response.json() if response.ok else {}
+            except self.__errors:
+                return None
+        return data.get('country') or ''
+
+    def resolve(self, lookups):
+        """Return the translations of codes looked up by candidate country.
+
+        Every candidate is queried at once, and a code takes the first
+        candidate, in the order given, that knows it. Codes that no
+        candidate knows but that the API did not always answer for map to
+        None.
+        """
+        with ThreadPoolExecutor(self.__workers) as executor:
+            futures = {(zip_code, country): executor.submit(
+                           self.__fetch, country, zip_code)
+                       for zip_code, codes in lookups.items()
+                       for country in codes}
+            translations = {}
+            for zip_code, codes in lookups.items():
+                for country in codes:
+                    translation = futures[(zip_code, country)].result()
+                    if translation:
+                        translations[zip_code] = translation
+                        break
+                    if translation is None:
+                        translations[zip_code] = None
+        return translations
+
+
+class PostalTranslator(object):
+
+    def __init__(self, index=None, resolver=None, cache=None,
+                 recovery=None):
+        """Initialize a PostalTranslator object."""
+        self.__translations = {} # country names by normalized code
+        self.__confidences = {} # confidence in the recovered codes
+        self.__index = index # offline postal index
+        self.__resolver = resolver # looks up the codes left with the API
+        self.__cache = cache # translations of earlier runs
+        self.__recovery = recovery # matches malformed codes offline
+
+    def translate(self, zip_codes):
+        """Return the classified distinct codes with their country names.
+
+        Codes matched exactly are translated with a confidence of 1.
+        """
+        # Translate every distinct code once; the codes left unresolved
+        # offline are looked up with the API together.
+        codes = classify(zip_codes)
+        lookups = {}
+        unidentified = {}
+        for key, candidates in zip(codes['key'], codes['candidates']):
+            if key in self.__translations or key in lookups:
+                continue
+            translation = self.__translate_offline(key, candidates)
+            if translation is None:
+                lookups[key] = candidates
+            else:
+                self.__translations[key] = translation
+            if key and translation in (None, NOT_IDENTIFIED):
+                unidentified[key] = candidates
+        found = {}
+        if self.__resolver is not None and lookups:
+            found = self.__resolver.resolve(lookups)
+        unanswered = 0
+        for key in lookups:
+            if found.get(key):
+                self.__store(key, found[key], True)
+            elif not key:
+                self.__translations[key] = NOT_PROVIDED
+            elif key in found:
+                # Not cached, so that a later run asks again.
+                self.__translations[key] = NOT_IDENTIFIED
+                unanswered += 1
+            else:
+                self.__store(key, NOT_IDENTIFIED, False)
+        if unanswered:
+            logging.getLogger(__name__).warning(
+                'the postal code API did not answer for %d codes', unanswered)
+        # Only the codes no source knows are recovered, so that well-formed
+        # codes missing from the index are asked about first.
+        unidentified = {key: candidates
+                        for key, candidates in unidentified.items()
+                        if self.__translations[key] == NOT_IDENTIFIED}
+        if self.__recovery is not None and unidentified:
+            recovered = self.__recovery.recover(unidentified)
+            for key, (translation, confidence) in recovered.items():
+                self.__translations[key] = translation
+                self.__confidences[key] = confidence
+        codes['translation'] = codes['key'].map(self.__translations)
+        codes['confidence'] = codes['key'].map(self.__confidences)
+        resolved = ~codes['translation'].isin([NOT_PROVIDED, NOT_IDENTIFIED])
+        codes.loc[resolved & codes['confidence'].isnull(), 'confidence'] = 1.0
+        return codes
+
+    def __translate_offline(self, zip_code, codes):
+        """Return the indexed or cached translation of a code, if any."""
+        # The index goes first, so failures cached before it was built do
+        # not hide its codes.
+        if self.__index is not None:
+            translation = self.__index.get_country(zip_code, codes)
+            if translation is not None:
+                return translation
+        if zip_code and self.__cache is not None:
+            return self.__cache.get(zip_code)
+        return None
+
+    def __store(self, zip_code, translation, found):
+        """Record the translation of a code."""
+        self.__translations[zip_code] = translation
+        # Failures are only cached once the API was asked too.
+        if (zip_code and self.__cache is not None
+                and (found or self.__resolver is not None)):
+            self.__cache.put(zip_code, translation, found)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    parser = argparse.ArgumentParser(
+        description='Build the offline postal index from a GeoNames dump.')
+    parser.add_argument('source', nargs='?', default=source_filepath,
+                        help='GeoNames postal code dump (.zip or .txt)')
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(index_filepath), exist_ok=True)
+    build_index(args.source, index_filepath)
@@ -0,0 +1,187 @@
+import collections
+import re
+
+from src.features import postal_index
+
+GRAM_SIZE = 3 # characters per gram of the fuzzy index
+PADDING = '$' * (GRAM_SIZE - 1) # lets the first and last characters in grams
+MAX_DISTANCE = 1 # edits between a code and the valid codes it may match
+MIN_CONFIDENCE = 0.5 # recovered codes below this stay unidentified
+# Countries whose codes are searched when a code has no candidate country,
+# by whether it has letters.
+DIGIT_COUNTRIES = [country for name, countries
+                   in postal_index.FORMAT_COUNTRIES.items()
+                   if name not in ('canada', 'uk') for country in countries]
+ALPHANUMERIC_COUNTRIES = ['ca', 'gb']
+# Country-specific repairs: the country, a pattern over the code without
+# punctuation, the repaired code and the confidence in the repair.
+REPAIR_RULES = [
+    # ZIP+4 codes without the hyphen, or with a USA prefix
+    ('us', r'^(?:USA?)?([0-9]{5})(?:[0-9]{4})?$', r'\1', 0.95),
+    # Full UK postcodes, of which only the outward code is indexed
+    ('gb', r'^(?:GB|UK)?([A-Z]{1,2}[0-9][A-Z0-9]?)[0-9][A-Z]{2}$', r'\1',
+     0.95),
+    # Canadian codes with characters out of place, matched by their first
+    # half
+    ('ca', r'^(?=.*[A-Z])(?=.*[0-9])([A-Z0-9]{3})[A-Z0-9]{3}$', r'\1', 0.9),
+    # Portuguese and Polish codes without the hyphen
+    ('pt', r'^([0-9]{4})([0-9]{3})$', r'\1-\2', 0.9),
+    ('pl', r'^([0-9]{2})([0-9]{3})$', r'\1-\2', 0.6),
+    # German, Swiss and Austrian codes with a country prefix
+    ('de', r'^D([0-9]{5})$', r'\1', 0.9),
+    ('ch', r'^CH([0-9]{4})$', r'\1', 0.9),
+    ('at', r'^A([0-9]{4})$', r'\1', 0.9)
+    ]
+REPAIR_PATTERNS = [(country, re.compile(pattern), repair, confidence)
+                   for country, pattern, repair, confidence in REPAIR_RULES]
+
+
+def get_grams(code):
+    """Return the distinct padded grams of a code."""
+    padded = PADDING + code + PADDING
+    return {padded[i:i+GRAM_SIZE]
+            for i in range(len(padded) - GRAM_SIZE + 1)}
+
+
+def get_distance(a, b):
+    """Return the edit distance of two codes, counting transpositions."""
+    previous = None
+    row = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        before, previous, row = previous, row, [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(previous[j] + 1, row[j-1] + 1,
+                         previous[j-1] + (a[i-1] != b[j-1]))
+            if (i > 1 and j > 1 and a[i-1] == b[j-2]
+                    and a[i-2] == b[j-1]):
+                row[j] = min(row[j], before[j-2] + 1)
+    return row[-1]
+
+
+class GramIndex(object):
+
+    def __init__(self, codes):
+        """Initialize a GramIndex object."""
+        self.__codes = list(codes)
+        self.__lengths = {len(code) for code in self.__codes}
+        self.__postings = collections.defaultdict(list) # codes by gram
+        for i, code in enumerate(self.__codes):
+            for gram in get_grams(code):
+                self.__postings[gram].append(i)
+
+    def search(self, code, max_distance=MAX_DISTANCE):
+        """Return the distance and code of the indexed codes near a code."""
+        if not any(abs(length - len(code)) <= max_distance
+                   for length in self.__lengths):
+            return []
+        grams = get_grams(code)
+        # Each edit removes at most GRAM_SIZE + 1 of the code's grams.
+        needed = len(grams) - (GRAM_SIZE + 1) * max_distance
+        shared = collections.Counter()
+        for gram in grams:
+            shared.update(self.__postings.get(gram, ()))
+        matches = []
+        for i, count in shared.items():
+            candidate = self.__codes[i]
+            if (count < needed
+                    or abs(len(candidate) - len(code)) > max_distance):
+                continue
+            distance = get_distance(code, candidate)
+            if distance <= max_distance:
+                matches.append((distance, candidate))
+        return sorted(matches)
+
+
+class PostalRecovery(object):
+
+    def __init__(self, index, max_distance=MAX_DISTANCE,
+                 min_confidence=MIN_CONFIDENCE):
+        """Initialize a PostalRecovery object."""
+        self.__index = index
+        self.__max_distance = max_distance
+        self.__min_confidence = min_confidence
+        self.__grams = {} # fuzzy index of every country searched
+        self.__counts = {'attempted': 0, 'repaired': 0, 'matched': 0}
+
+    def __get_grams(self, country):
+        """Return the fuzzy index of a country's codes, building it once."""
+        if country not in self.__grams:
+            self.__grams[country] = GramIndex(self.__index.get_codes(country))
+        return self.__grams[country]
+
+    def __repair(self, code):
+        """Return the repaired code, country and confidence of each rule."""
+        repairs = []
+        for country, pattern, repair, confidence in REPAIR_PATTERNS:
+            match = pattern.match(code)
+            if match:
+                repaired = postal_index.normalize(match.expand(repair),
+                                                  country)
+                repairs.append((repaired, country, confidence))
+        return sorted(repairs, key=lambda repair: -repair[2])
+
+    def __match(self, targets):
+        """Return the most likely country of the codes near the targets."""
+        matches = []
+        for code, country, confidence in targets:
+            for distance, _ in self.__get_grams(country).search(
+                    code, self.__max_distance):
+                matches.append((distance, country,
+                                confidence * (1 - distance / len(code))))
+        if not matches:
+            return None
+        # The nearest matches vote on the country.
+        nearest = min(distance for distance, _, _ in matches)
+        votes = collections.Counter()
+        for distance, country, confidence in matches:
+            if distance == nearest:
+                votes[country] += 1
+        country, count = votes.most_common(1)[0]
+        confidence = max(confidence for distance, match, confidence in matches
+                         if distance == nearest and match == country)
+        return country, confidence * count / sum(votes.values())
+
+    def recover(self, lookups):
+        """Return the translation and confidence of the codes recovered.
+
+        The lookups are the candidate countries of codes that were not
+        identified; only the local index is searched.
+        """
+        recovered = {}
+        for zip_code, candidates in lookups.items():
+            code = re.sub('[^A-Z0-9]', '', zip_code)
+            if not re.search('[0-9]', code):
+                continue # no country has postal codes without digits
+            self.__counts['attempted'] += 1
+            repairs = self.__repair(code)
+            result = None
+            for repaired, country, confidence in repairs:
+                if self.__index.get_country(repaired, [country]):
+                    result = (country, confidence)
+                    self.__counts['repaired'] += 1
+                    break
+            if result is None:
+                # Other codes are searched whole, as only the repairs know
+                # which part of a code is indexed; codes of a known format
+                # keep their punctuation.
+                if candidates:
+                    targets = [(zip_code, country, 1.0)
+                               for country in candidates]
+                else:
+                    countries = (ALPHANUMERIC_COUNTRIES
+                                 if re.search('[A-Z]', code)
+                                 else DIGIT_COUNTRIES)
+                    targets = [(code, country, 1.0) for country in countries]
+                result = self.__match(repairs + targets)
+                if result is None or result[1] < self.__min_confidence:
+                    continue
+                self.__counts['matched'] += 1
+            country, confidence = result
+            recovered[zip_code] = (
+                postal_index.COUNTRY_NAMES.get(country, country.upper()),
+                round(confidence, 3))
+        return recovered
+
+    def get_counts(self):
+        """Return the codes attempted, repaired and matched to near codes."""
+        return dict(self.__counts)
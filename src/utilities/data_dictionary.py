@@ -0,0 +1,235 @@
+import csv
+import hashlib
+import json
+import os
+import re
+
+import pandas as pd
+
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir, os.pardir)
+artifact_filepath = os.path.join(project_dir, 'data', 'interim',
+                                 'data_dictionary.json')
+# Bumped whenever the layout of the compiled artifact changes.
+ARTIFACT_VERSION = 1
+# Column that REDCap adds after the record ID of a longitudinal export.
+EVENT_COLUMN = 'redcap_event_name'
+# Forms exported once per instance, with the field that the last instance
+# lacks.
+REPEATED_FORMS = {
+    'phase_1': (5, 'phase1_repeat')
+    }
+# Field whose choices translate breed codes to breed names.
+BREED_FIELD = 'purebred_breed'
+
+# SQLite column types for each REDCap field type.
+SQL_TYPES = {
+    'yesno': 'INTEGER',
+    'checkbox': 'INTEGER',
+    'radio': 'INTEGER',
+    'dropdown': 'INTEGER',
+    'complete': 'INTEGER',
+    'calc': 'REAL'
+    }
+# SQLite column types for each text validation type.
+VALIDATION_TYPES = {
+    'number': 'REAL',
+    'integer': 'INTEGER'
+    }
+# Field types that hold coded choices.
+CHOICE_TYPES = ['yesno', 'checkbox', 'radio', 'dropdown']
+
+
+def clean_column(name):
+    """Return the export column name with the form suffixes removed."""
+    name = re.sub('_1[a-e]', '', name)
+    return re.sub('___', '_', name)
+
+
+def parse_choices(field_type, choices):
+    """Return the choice codes and labels of a coded field."""
+    if field_type not in ('checkbox', 'radio', 'dropdown'):
+        return {}
+    parsed = {}
+    for choice in choices.split('|'):
+        code, _, label = choice.partition(',')
+        parsed[code.strip()] = label.strip()
+    return parsed
+
+
+def get_digest(path):
+    """Return the SHA-256 digest of a file's content."""
+    with open(path, 'rb') as fin:
+        return hashlib.sha256(fin.read()).hexdigest()
+
+
+def compile_dictionary(path, digest):
+    """Compile the data dictionary into its artifact."""
+    fields = []
+    forms = {}
+    with open(path, newline='', encoding='latin1') as csvfile:
+        csvreader = csv.reader(csvfile, delimiter=',')
+        next(csvreader, None) # header
+        for row in csvreader:
+            if not row:
+                continue
+            field = {
+                'name': row[0],
+                'form': row[1],
+                'type': row[3],
+                'choices': parse_choices(row[3], row[5]),
+                'validation': row[7]
+                }
+            fields.append(field)
+            # Cleaned export columns of every form, in export order.
+            columns = forms.setdefault(row[1], {'columns': []})['columns']
+            if field['type'] == 'descriptive':
+                continue
+            if field['type'] == 'checkbox':
+                columns.extend('%s_%s' %(row[0], code)
+                               for code in field['choices'])
+            else:
+                columns.append(row[0])
+            if len(fields) == 1: # the record ID
+                columns.append(EVENT_COLUMN)
+    # Raw export offsets of every instance of a form.
+    offset = 0
+    for form, layout in forms.items():
+        layout['columns'].append('%s_complete' %form)
+        width = len(layout['columns'])
+        count, missing = REPEATED_FORMS.get(form, (1, None))
+        layout['blocks'] = []
+        for i in range(count):
+            end = offset + width
+            if missing and i == count - 1:
+                end -= 1
+            layout['blocks'].append([offset, end])
+            offset = end
+    breeds = next((field['choices'] for field in fields
+                   if field['name'] == BREED_FIELD), {})
+    return {'version': ARTIFACT_VERSION, 'sha256': digest, 'fields': fields,
+            'breeds': breeds, 'forms': forms}
+
+
+def read_artifact(artifact_path, digest):
+    """Return the compiled artifact if it matches the dictionary content."""
+    try:
+        with open(artifact_path, 'r') as fin:
+            artifact = json.load(fin)
+    except (OSError, ValueError):
+        return None # no usable artifact yet
+    if (artifact.get('version') != ARTIFACT_VERSION
+            or artifact.get('sha256') != digest):
+        return None
+    return artifact
+
+
+def write_artifact(artifact, artifact_path):
+    """Write the compiled artifact."""
+    # Replace the artifact atomically, as other processes may be reading it.
+    os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+    temp_path = '%s.%d' %(artifact_path, os.getpid())
+    with open(temp_path, 'w') as fout:
+        json.dump(artifact, fout)
+    os.replace(temp_path, artifact_path)
+
+
+class DataDictionary(object):
+
+    def __init__(self, path, artifact_path=artifact_filepath):
+        """Initialize a DataDictionary object."""
+        digest = get_digest(path)
+        artifact = read_artifact(artifact_path, digest)
+        if artifact is None:
+            # Compiled in memory only; save() writes it for later runs.
+            artifact = compile_dictionary(path, digest)
+            self.__unsaved = artifact
+        else:
+            self.__unsaved = None
+        self.__artifact_path = artifact_path
+        self.__fields = {}
+        self.__columns = {}
+        self.__breeds = artifact['breeds']
+        self.__forms = artifact['forms']
+        for field in artifact['fields']:
+            self.__fields[field['name']] = field
+            if field['type'] == 'checkbox':
+                # Checkbox fields are exported as one column per choice.
+                for code in field['choices']:
+                    self.__columns['%s_%s' %(field['name'], code)] = field
+            else:
+                self.__columns[field['name']] = field
+
+    def save(self):
+        """Write the compiled artifact if it is missing or outdated."""
+        if self.__unsaved is not None:
+            write_artifact(self.__unsaved, self.__artifact_path)
+            self.__unsaved = None
+
+    def get_field(self, name):
+        """Return the definition of a field."""
+        return self.__fields.get(name)
+
+    def get_column_field(self, column):
+        """Return the definition of the field behind a cleaned column."""
+        return self.__columns.get(column)
+
+    def get_field_type(self, column):
+        """Return the REDCap field type of a cleaned column."""
+        if column.endswith('_complete'):
+            return 'complete'
+        field = self.__columns.get(column)
+        return field['type'] if field else None
+
+    def get_breeds(self):
+        """Return the breed names by breed code."""
+        return self.__breeds
+
+    def get_email_fields(self):
+        """Return the fields validated as email addresses."""
+        return {name for name, field in self.__fields.items()
+                if field['validation'] == 'email'}
+
+    def get_blocks(self, form):
+        """Return the raw export offsets of every instance of a form."""
+        return [tuple(block) for block in self.__forms[form]['blocks']]
+
+    def get_column(self, form, column):
+        """Return the offset of a cleaned column within its form."""
+        return self.__forms[form]['columns'].index(column)
+
+    def get_sql_type(self, column):
+        """Return the SQLite type of a cleaned column."""
+        field_type = self.get_field_type(column)
+        if field_type in SQL_TYPES:
+            return SQL_TYPES[field_type]
+        field = self.__columns.get(column)
+        if field and field['validation'] in VALIDATION_TYPES:
+            return VALIDATION_TYPES[field['validation']]
+        return 'TEXT'
+
+
+def get_declared_types(con, table):
+    """Return the declared SQLite type of every column in a table."""
+    cursor = con.execute('PRAGMA table_info(%s);' %table)
+    return {row[1]: row[2].upper() for row in cursor.fetchall()}
+
+
+def compact_series(series, sql_type, field_type=None):
+    """Return the series with the most compact pandas dtype for its type."""
+    if sql_type == 'INTEGER':
+        series = pd.to_numeric(series, errors='coerce')
+        if not series.isnull().any():
+            return pd.to_numeric(series, downcast='integer')
+        values = series.dropna()
+        if (values != values.round()).any():
+            return series.astype('float32') # values stored off type
+        # Missing answers, e.g. of yes/no fields, keep a nullable integer
+        # dtype such as Int8.
+        dtype = pd.to_numeric(values, downcast='integer').dtype
+        return series.astype(dtype.name.capitalize())
+    if sql_type == 'REAL':
+        return pd.to_numeric(series, errors='coerce').astype('float32')
+    if field_type in CHOICE_TYPES:
+        # Choice fields stored as text, e.g. translated breed names.
+        return series.astype('category')
+    return series
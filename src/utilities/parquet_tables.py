@@ -0,0 +1,159 @@
+import os
+import re
+
+from src.utilities import data_dictionary as datadict
+
+# Tables of the processed database that are also exported as Parquet.
+PARQUET_TABLES = ['users', 'dogs', 'feedback', 'dogs_adjusted']
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_BATCH_SIZE = 20000 # rows per fetch and row group
+# Column selections that can be read from Parquet instead of SQLite.
+COLUMN_LIST = re.compile(r'^\s*\w+(\s*,\s*\w+)*\s*$')
+
+
+def get_path(directory, table):
+    """Return the path of a table's Parquet file."""
+    return os.path.join(directory, '%s.parquet' %table)
+
+
+def get_arrow_type(pa, sql_type):
+    """Return the Arrow type of a declared SQLite type."""
+    if sql_type in ('INTEGER', 'INT'): # INT in tables created by a SELECT
+        return pa.int64()
+    if sql_type == 'REAL':
+        return pa.float64()
+    return pa.string()
+
+
+def to_array(pa, values, arrow_type):
+    """Return the values as an Arrow array, or None if they do not fit."""
+    try:
+        return pa.array(values, type=arrow_type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return None
+
+
+def to_text(pa, values):
+    """Return the values as an Arrow array of text."""
+    return pa.array([None if value is None else str(value)
+                     for value in values], type=pa.string())
+
+
+def remove_tables(directory, tables=PARQUET_TABLES):
+    """Remove the Parquet files of the tables."""
+    for table in tables:
+        path = get_path(directory, table)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def get_schema(pa, con, table, names, text_columns):
+    """Return the Arrow schema of a table's columns."""
+    types = datadict.get_declared_types(con, table)
+    return pa.schema([
+        (name, pa.string() if name in text_columns
+         else get_arrow_type(pa, types.get(name, 'TEXT')))
+        for name in names])
+
+
+def to_arrays(pa, rows, schema, text_columns):
+    """Return the Arrow arrays of a batch and the columns that do not fit."""
+    arrays = []
+    mismatches = set()
+    for field, values in zip(schema, zip(*rows)):
+        if field.name in text_columns:
+            arrays.append(to_text(pa, values))
+            continue
+        array = to_array(pa, values, field.type)
+        if array is None:
+            mismatches.add(field.name)
+        arrays.append(array)
+    return arrays, mismatches
+
+
+def write_table(pa, pq, con, table, path, text_columns=None,
+                batch_size=PARQUET_BATCH_SIZE):
+    """Stream a table into a Parquet file, one row group per batch.
+
+    SQLite keeps values that do not match the declared type as is, so the
+    columns holding any are written as text. Returns the columns found
+    after the first row group was written, in which case nothing is.
+    """
+    text_columns = set(text_columns or ())
+    cursor = con.execute('SELECT * FROM %s;' %table)
+    names = [column[0] for column in cursor.description]
+    schema = get_schema(pa, con, table, names, text_columns)
+    temp_path = path + '.part'
+    writer = None
+    try:
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            arrays, mismatches = to_arrays(pa, rows, schema, text_columns)
+            if mismatches and writer is not None:
+                return mismatches # the written row groups have the old schema
+            if mismatches:
+                text_columns |= mismatches
+                schema = get_schema(pa, con, table, names, text_columns)
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(temp_path, schema,
+                                          compression=PARQUET_COMPRESSION)
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows = cursor.fetchmany(batch_size)
+        if writer is None:
+            # An empty table still gets a file with its schema.
+            writer = pq.ParquetWriter(temp_path, schema,
+                                      compression=PARQUET_COMPRESSION)
+    finally:
+        if writer is not None:
+            writer.close()
+    os.replace(temp_path, path)
+    return set()
+
+
+def write_tables(con, directory, tables=PARQUET_TABLES,
+                 batch_size=PARQUET_BATCH_SIZE):
+    """Export the tables as Parquet, returning False if pyarrow is missing."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        # Never leave files that no longer match the database.
+        remove_tables(directory, tables)
+        return False
+    for table in tables:
+        path = get_path(directory, table)
+        text_columns = set()
+        mismatches = write_table(pa, pq, con, table, path,
+                                 batch_size=batch_size)
+        while mismatches:
+            # A later batch held values of another type, so the table is
+            # written again with those columns as text.
+            text_columns |= mismatches
+            mismatches = write_table(pa, pq, con, table, path, text_columns,
+                                     batch_size)
+    return True
+
+
+def read_table(directory, table, fields=None, source=None):
+    """Return a table read from Parquet, or None if it is unavailable.
+
+    The fields are a comma-separated column list; anything else, e.g. an
+    aggregate, has to be queried from the database instead.
+    """
+    path = get_path(directory, table)
+    if fields is not None and not COLUMN_LIST.match(fields):
+        return None
+    if not os.path.exists(path):
+        return None
+    if source and os.path.getmtime(path) < os.path.getmtime(source):
+        return None # exported before the database last changed
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    columns = None
+    if fields is not None:
+        columns = [field.strip() for field in fields.split(',')]
+    return pq.read_table(path, columns=columns,
+                         memory_map=True).to_pandas()
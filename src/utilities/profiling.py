@@ -0,0 +1,147 @@
+import atexit
+import collections
+import contextlib
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+# Directory that enables profiling when set in the environment.
+PROFILE_VARIABLE = 'PDBS_PROFILE'
+# Seconds between the stack samples of the collapsed stack files.
+SAMPLE_INTERVAL = 0.005
+# Frames kept per traced allocation.
+TRACE_FRAMES = 25
+# Shared by every stage while profiling is disabled.
+NULL_STAGE = contextlib.nullcontext()
+
+_profiler = None
+
+
+def get_profiler():
+    """Return the profiler of this process, or None if profiling is off."""
+    global _profiler
+    path = os.environ.get(PROFILE_VARIABLE)
+    if _profiler is None and path:
+        run = '%s_%d' %(time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        _profiler = Profiler(os.path.join(path, run))
+    return _profiler
+
+
+def reset():
+    """Drop the profiler a worker process inherited from its parent."""
+    global _profiler
+    if _profiler is not None:
+        _profiler.discard()
+        _profiler = None
+
+
+def stage(name):
+    """Return a context that profiles a stage when profiling is on."""
+    profiler = get_profiler()
+    if profiler is None:
+        return NULL_STAGE
+    return profiler.stage(name)
+
+
+def get_label(frame):
+    """Return the collapsed stack label of a frame."""
+    code = frame.f_code
+    return '%s (%s:%d)' %(code.co_name, os.path.basename(code.co_filename),
+                          code.co_firstlineno)
+
+
+class Sampler(threading.Thread):
+
+    def __init__(self, ident, interval=SAMPLE_INTERVAL):
+        """Initialize a Sampler object."""
+        super().__init__(daemon=True)
+        self.__ident = ident # thread whose stacks are sampled
+        self.__interval = interval
+        self.__done = threading.Event()
+        self.__stacks = collections.Counter()
+
+    def run(self):
+        """Sample the stack of the profiled thread until stopped."""
+        while not self.__done.wait(self.__interval):
+            frame = sys._current_frames().get(self.__ident)
+            stack = []
+            while frame is not None:
+                stack.append(get_label(frame))
+                frame = frame.f_back
+            if stack:
+                self.__stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        """Stop sampling and return the sample count of every stack."""
+        self.__done.set()
+        self.join()
+        return self.__stacks
+
+
+class Profiler(object):
+
+    def __init__(self, path):
+        """Initialize a Profiler object."""
+        self.__path = path
+        self.__stages = []
+        self.__stage = None # name, start time, profile and sampler
+        os.makedirs(path, exist_ok=True)
+        atexit.register(self.stop)
+
+    def start(self, name):
+        """Start profiling a stage, ending the running one."""
+        self.stop()
+        tracemalloc.start(TRACE_FRAMES)
+        sampler = Sampler(threading.get_ident())
+        sampler.start()
+        profile = cProfile.Profile()
+        self.__stage = (name, time.perf_counter(), profile, sampler)
+        profile.enable()
+
+    def stop(self):
+        """End the running stage and write its reports."""
+        if self.__stage is None:
+            return
+        name, start, profile, sampler = self.__stage
+        profile.disable()
+        seconds = time.perf_counter() - start
+        stacks = sampler.stop()
+        peak = tracemalloc.get_traced_memory()[1]
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        self.__stage = None
+        prefix = os.path.join(self.__path,
+                              '%02d_%s' %(len(self.__stages) + 1, name))
+        profile.dump_stats(prefix + '.pstats')
+        snapshot.dump(prefix + '.tracemalloc')
+        with open(prefix + '.folded', 'w') as fout:
+            for stack, count in stacks.items():
+                fout.write('%s %d\n' %(stack, count))
+        self.__stages.append({'stage': name, 'seconds': round(seconds, 3),
+                              'peak_bytes': peak,
+                              'samples': sum(stacks.values()),
+                              'files': os.path.basename(prefix)})
+        with open(os.path.join(self.__path, 'summary.json'), 'w') as fout:
+            json.dump(self.__stages, fout, indent=2)
+            fout.write('\n')
+
+    def discard(self):
+        """End the running stage without writing its reports."""
+        atexit.unregister(self.stop)
+        if self.__stage is not None:
+            self.__stage[2].disable()
+            tracemalloc.stop()
+            self.__stage = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Profile the enclosed block as a stage."""
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
@@ -0,0 +1,72 @@
+import collections
+import datetime
+import json
+import time
+
+
+class Metrics(object):
+
+    def __init__(self, profiler=None):
+        """Initialize a Metrics object."""
+        self.__profiler = profiler # also profiles the stages, if given
+        self.__started = datetime.datetime.now()
+        self.__stages = []
+        self.__stage = None # name and start time of the running stage
+        self.__counters = collections.defaultdict(collections.Counter)
+        self.__sections = {}
+
+    def start(self, stage):
+        """Start timing a stage, ending the running one."""
+        self.stop()
+        self.__stage = (stage, time.perf_counter())
+        if self.__profiler:
+            self.__profiler.start(stage)
+
+    def stop(self, rows=None):
+        """End the running stage, recording the rows it handled."""
+        if self.__stage is None:
+            return
+        name, start = self.__stage
+        seconds = time.perf_counter() - start
+        if self.__profiler:
+            self.__profiler.stop()
+        stage = {'stage': name, 'seconds': round(seconds, 3)}
+        if rows is not None:
+            stage['rows'] = rows
+            stage['rows_per_second'] = (round(rows / seconds, 1)
+                                        if seconds else None)
+        self.__stages.append(stage)
+        self.__stage = None
+
+    def count(self, group, key, amount=1):
+        """Add to the counter of a key within a group."""
+        self.__counters[group][key] += amount
+
+    def add_counters(self, counters):
+        """Add grouped counters, e.g. those of a worker process."""
+        for group, counts in counters.items():
+            self.__counters[group].update(counts)
+
+    def get_counters(self):
+        """Return the grouped counters."""
+        return {group: dict(counts)
+                for group, counts in self.__counters.items()}
+
+    def set_section(self, name, values):
+        """Set a section of the report."""
+        self.__sections[name] = values
+
+    def write(self, path):
+        """Write the report as JSON, ending the running stage."""
+        self.stop()
+        report = {
+            'started': self.__started.isoformat(timespec='seconds'),
+            'seconds': round(sum(stage['seconds']
+                                 for stage in self.__stages), 3),
+            'stages': self.__stages,
+            'counters': self.get_counters()
+            }
+        report.update(self.__sections)
+        with open(path, 'w') as fout:
+            json.dump(report, fout, indent=2)
+            fout.write('\n')
@@ -0,0 +1,215 @@
+import csv
+import http.server
+import io
+import os
+import random
+import sys
+import threading
+import urllib.parse
+
+import pytest
+
+# Make the src package importable from the tests.
+project_dir = os.path.join(os.path.dirname(__file__), os.pardir)
+sys.path.insert(0, project_dir)
+data_dictionary = os.path.join(project_dir, 'docs', 'data_dictionary.csv')
+# Values drawn for the generated export.
+AGES = ['2 years', '6 months', '1.5', '3', 'two', '1/2', '2-3',
+        '1 year 6 months', '10 weeks', '', 'abc', '4 and a half', '500']
+ZIP_CODES = ['12345', '12345-6789', 'K1A 0B1', 'SW1A 1AA', '2000', 'N/A', '']
+DOG_NAMES = ['Rex', 'rex', 'Fido', 'Bella', 'Max']
+
+
+class FakeRedcap(object):
+    """A REDCap project served over HTTP from rows held in memory."""
+
+    def __init__(self, header, rows):
+        self.header = header
+        self.rows = rows
+        self.modified = {} # record_id to the time of its last change
+        self.requests = [] # form of every request received
+        self.truncate_after = None # export requests to serve in full
+        self.url = None
+
+    def export(self, form):
+        """Return the CSV body answering a record export request."""
+        header, rows = self.header, self.rows
+        records = {value for key, value in form.items()
+                   if key.startswith('records[')}
+        fields = [value for key, value in sorted(form.items())
+                  if key.startswith('fields[')]
+        if records:
+            rows = [row for row in rows if row[0] in records]
+        if 'dateRangeBegin' in form:
+            rows = [row for row in rows if self.modified.get(row[0], '')
+                    >= form['dateRangeBegin']]
+        if fields:
+            columns = [header.index(field) for field in fields]
+            header = fields
+            rows = [[row[i] for i in columns] for row in rows]
+        body = io.StringIO()
+        writer = csv.writer(body)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return body.getvalue().encode('utf-8')
+
+
+def get_form_columns(fields, form, suffix=''):
+    """Return the export columns of a form with their dictionary rows."""
+    columns = []
+    for field in fields:
+        if field[1] != form or field[3] == 'descriptive':
+            continue
+        if field[3] == 'checkbox':
+            for choice in field[5].split('|'):
+                columns.append(('%s%s___%s' %(field[0], suffix,
+                                              choice.split(',')[0].strip()),
+                                field))
+        else:
+            columns.append((field[0] + suffix, field))
+    return columns
+
+
+def get_export_columns():
+    """Return the columns of a phase 1 export with their dictionary rows."""
+    with open(data_dictionary, 'r', encoding='latin1') as fin:
+        fields = list(csv.reader(fin))[1:]
+    welcome = get_form_columns(fields, 'phase_1_welcome')
+    columns = [welcome[0], ('redcap_event_name', None)]
+    columns.extend(welcome[1:])
+    columns.append(('phase_1_welcome_complete', None))
+    for letter in 'abcde':
+        dogs = get_form_columns(fields, 'phase_1', '_1' + letter)
+        if letter == 'e':
+            # The last dog form lacks the repeat question.
+            dogs = [dog for dog in dogs
+                    if not dog[0].startswith('phase1_repeat')]
+        columns.extend(dogs)
+        columns.append(('phase_1%s_complete' %letter, None))
+    columns.extend(get_form_columns(fields, 'phase_1_feedback'))
+    columns.append(('phase_1_feedback_complete', None))
+    return columns
+
+
+def make_value(column, field, generator):
+    """Return a random raw value for an export column."""
+    if column.endswith('_complete'):
+        return generator.choice(['0', '2', '2'])
+    elif field is None:
+        return ''
+    elif field[0] == 'zip_code':
+        return generator.choice(ZIP_CODES)
+    elif field[0] == 'dog_name':
+        return generator.choice(DOG_NAMES)
+    elif field[0] == 'purebred_breed':
+        return generator.choice(['', '1', '2', '3'])
+    elif ('months' in field[0] or 'years' in field[0]
+            or field[0] in ('dog_sex_month', 'dog_sex_year')):
+        return generator.choice(AGES)
+    elif field[3] == 'checkbox':
+        return generator.choice('01')
+    elif field[3] == 'yesno':
+        return generator.choice(['0', '1', ''])
+    elif field[3] in ('radio', 'dropdown'):
+        return generator.choice([''] + [choice.split(',')[0].strip()
+                                        for choice in field[5].split('|')])
+    elif field[3] == 'calc':
+        return str(generator.randint(0, 5))
+    return generator.choice(['', 'some text, "quoted"\nmultiline', 'x'])
+
+
+class ExportGenerator(object):
+    """Generates raw phase 1 export rows shaped by the data dictionary."""
+
+    def __init__(self, seed=1):
+        self.columns = get_export_columns()
+        self.header = [column for column, _ in self.columns]
+        self.random = random.Random(seed)
+        self.record_id = 0
+
+    def make_row(self, email, event='event_1_arm_1', record_id=None):
+        """Return a random row of a user."""
+        if record_id is None:
+            self.record_id += 1
+            record_id = self.record_id
+        row = []
+        for column, field in self.columns:
+            if column == 'record_id':
+                row.append(str(record_id))
+            elif column == 'redcap_event_name':
+                row.append(event)
+            elif column == 'email':
+                row.append(email)
+            else:
+                row.append(make_value(column, field, self.random))
+        return row
+
+    def make_rows(self, count, users):
+        """Return random rows of the provided number of users."""
+        return [self.make_row('user%d@example.org'
+                              %self.random.randint(1, users),
+                              self.random.choice(['event_1_arm_1'] * 9
+                                                 + ['event_2_arm_1']))
+                for _ in range(count)]
+
+
+@pytest.fixture
+def export():
+    """Return a generator of raw export rows."""
+    return ExportGenerator()
+
+
+def make_handler(project):
+    """Return a request handler class serving the project."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers['Content-Length'])
+            form = dict(urllib.parse.parse_qsl(
+                self.rfile.read(length).decode('utf-8')))
+            project.requests.append(form)
+            if form.get('content') == 'version':
+                body = b'13.1.0'
+            else:
+                body = project.export(form)
+            exports = sum(1 for request in project.requests
+                          if request.get('content') == 'record')
+            truncated = (project.truncate_after is not None
+                         and exports > project.truncate_after)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/csv; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if truncated:
+                # Drop the connection halfway through the body.
+                self.wfile.write(body[:len(body) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def redcap():
+    """Serve a fake REDCap project for the duration of a test."""
+    header = ['record_id', 'redcap_event_name', 'email', 'dog_name']
+    rows = []
+    for i in range(1, 11):
+        rows.append([str(i), 'event_1_arm_1', 'user%d@example.org' %i,
+                     'dog, "%d"\nsecond line' %i])
+        rows.append([str(i), 'event_2_arm_1', '', 'follow-up'])
+    project = FakeRedcap(header, rows)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             make_handler(project))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    project.url = 'http://127.0.0.1:%d/' %server.server_port
+    yield project
+    server.shutdown()
+    server.server_close()
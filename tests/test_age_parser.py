@@ -0,0 +1,101 @@
+import csv
+import os
+import random
+import sqlite3
+
+import pytest
+
+import legacy_age_parser
+from src.data import age_parser
+
+corpus_filepath = os.path.join(os.path.dirname(__file__), 'data', 'ages.csv')
+# Fragments joined at random into the ages of the differential test.
+NUMBERS = ['0', '1', '2', '3', '6', '10', '12', '18', '40', '1.5', '.5',
+           '3,5', '2.', '1/2', '3/4', '1/7', '1/12']
+WORDS = ['one', 'two', 'three', 'ten', 'twelve', 'half', 'a', 'about', '?']
+UNITS = ['', ' years', ' year', 'yrs', 'y', ' months', ' mo', 'mon',
+         ' weeks', 'wks']
+JOINERS = [' ', '', '-', ' - ', ' to ', ' or ', '..', '+', ' and ',
+           ' and a ', '&', ', ', '/']
+FUZZ_COUNT = 5000 # generated ages per unit
+
+
+def read_corpus():
+    """Return the value, unit and expected months of the golden corpus."""
+    with open(corpus_filepath, newline='') as f:
+        return [(row['value'], row['unit'], row['months'])
+                for row in csv.DictReader(f)]
+
+
+def make_ages(count, seed=0):
+    """Return free-text ages joined at random from common fragments."""
+    rand = random.Random(seed)
+    ages = []
+    for _ in range(count):
+        parts = []
+        for _ in range(rand.randint(1, 3)):
+            parts.append(rand.choice(NUMBERS + WORDS) + rand.choice(UNITS))
+            parts.append(rand.choice(JOINERS))
+        age = ''.join(parts[:-1])
+        ages.append(age.upper() if rand.random() < 0.1 else age)
+    return ages
+
+
+@pytest.mark.parametrize('value,unit,months', read_corpus())
+def test_golden_corpus(value, unit, months):
+    assert age_parser.parse(value, unit) == months
+
+
+def test_golden_corpus_matches_legacy_parser():
+    for value, unit, months in read_corpus():
+        assert legacy_age_parser.parse_contents(value, unit) == months
+
+
+@pytest.mark.parametrize('unit', ['m', 'y'])
+def test_matches_legacy_parser(unit):
+    ages = make_ages(FUZZ_COUNT)
+    expected = [legacy_age_parser.parse_contents(age, unit) for age in ages]
+    assert [age_parser.parse(age, unit) for age in ages] == expected
+    assert age_parser.parse_many(ages, unit) == expected
+    # Both valid and invalid ages are generated.
+    assert '' in expected and set(expected) != {''}
+
+
+def test_age_cache_matches_legacy_parser():
+    ages = make_ages(FUZZ_COUNT, seed=1)
+    conn = sqlite3.connect(':memory:')
+    cache = age_parser.AgeCache(conn, size=100)
+    expected = [legacy_age_parser.parse_contents(age, 'y') for age in ages]
+    assert cache.parse_many(ages, 'y') == expected
+    cache.flush()
+    # A new cache answers from the stored table.
+    cache = age_parser.AgeCache(conn, size=100)
+    assert cache.parse_many(ages, 'y') == expected
+    assert cache.get_counts()['misses'] == 0
+
+
+def test_new_rules_invalidate_cached_ages():
+    conn = sqlite3.connect(':memory:')
+    cache = age_parser.AgeCache(conn, version='old')
+    cache.parse_many(['2 years', '6'], 'm')
+    cache.flush()
+    conn.commit()
+    cache = age_parser.AgeCache(conn, version='old')
+    cache.parse_many(['2 years', '6'], 'm')
+    assert cache.get_counts()['table_hits'] == 2
+    # Ages parsed by other rules are dropped and parsed again.
+    cache = age_parser.AgeCache(conn, version='new')
+    assert conn.execute('SELECT COUNT(*) FROM age_cache;').fetchone()[0] == 0
+    cache.parse_many(['2 years', '6'], 'm')
+    assert cache.get_counts() == {'memory_hits': 0, 'table_hits': 0,
+                                  'misses': 2}
+
+
+def test_unversioned_cache_is_dropped():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE age_cache (value TEXT, unit TEXT, '
+                 'months TEXT, PRIMARY KEY (value, unit));')
+    conn.execute("INSERT INTO age_cache VALUES ('2', 'm', '99.00');")
+    cache = age_parser.AgeCache(conn)
+    assert cache.parse('2', 'm') == '2.00'
+    assert cache.get_counts()['misses'] == 1
@@ -0,0 +1,128 @@
+import csv
+import datetime
+import json
+import os
+
+import pytest
+
+from src.data import fetch_raw_data
+
+KEY = 'test-key'
+
+
+def make_pseudonymizer():
+    """Return a pseudonymizer hashing the email column of the fake project."""
+    return fetch_raw_data.Pseudonymizer(KEY, ['email'])
+
+
+def read_csv(path):
+    """Return the rows of a CSV file."""
+    with open(path, 'r', newline='') as fin:
+        return list(csv.reader(fin))
+
+
+def get_exports(redcap):
+    """Return the record export requests the fake project received."""
+    return [form for form in redcap.requests
+            if form.get('content') == 'record' and 'fields[0]' not in form]
+
+
+def test_stream_records_scrubs_emails(redcap):
+    rows = list(fetch_raw_data.stream_records(redcap.url, 'token',
+                                              make_pseudonymizer()))
+    assert rows[0] == redcap.header
+    assert len(rows) == 11 # header and the phase 1 rows only
+    pseudonyms = fetch_raw_data.hash_emails(
+        KEY.encode('utf-8'), ['user%d@example.org' %i for i in range(1, 11)])
+    assert [row[2] for row in rows[1:]] == pseudonyms
+    # Quoted newlines survive the streamed parse.
+    assert rows[1][3] == 'dog, "1"\nsecond line'
+
+
+def test_stream_records_in_batches(redcap):
+    expected = list(fetch_raw_data.stream_records(redcap.url, 'token',
+                                                  make_pseudonymizer()))
+    redcap.requests.clear()
+    rows = list(fetch_raw_data.stream_records(redcap.url, 'token',
+                                              make_pseudonymizer(), 3))
+    assert rows == expected
+    batches = [sorted(value for key, value in form.items()
+                      if key.startswith('records['))
+               for form in get_exports(redcap)]
+    assert [len(batch) for batch in batches] == [3, 3, 3, 1]
+
+
+def test_fetch_batched_matches_fetch_all(redcap, tmp_path):
+    expected = str(tmp_path / 'all.csv')
+    outfile = str(tmp_path / 'raw.csv')
+    fetch_raw_data.fetch_all(redcap.url, 'token', expected,
+                             make_pseudonymizer())
+    fetch_raw_data.fetch_batched(redcap.url, 'token', outfile, 4,
+                                 make_pseudonymizer())
+    assert read_csv(outfile) == read_csv(expected)
+    assert not os.path.exists(outfile + '.progress')
+
+
+def test_fetch_batched_resumes_after_truncated_batch(redcap, tmp_path):
+    expected = str(tmp_path / 'all.csv')
+    outfile = str(tmp_path / 'raw.csv')
+    fetch_raw_data.fetch_all(redcap.url, 'token', expected,
+                             make_pseudonymizer())
+    redcap.requests.clear()
+    redcap.truncate_after = 3 # the record list and two batches
+    with pytest.raises(Exception):
+        fetch_raw_data.fetch_batched(redcap.url, 'token', outfile, 3,
+                                     make_pseudonymizer())
+    with open(outfile + '.progress', 'r') as fin:
+        progress = json.load(fin)
+    assert progress['completed'] == 2
+    assert os.path.getsize(outfile) == progress['offset']
+    # Rows of a larger batch would have been written before the drop.
+    with open(outfile, 'a') as fout:
+        fout.write('7,event_1_arm_1,partial')
+
+    redcap.requests.clear()
+    redcap.truncate_after = None
+    fetch_raw_data.fetch_batched(redcap.url, 'token', outfile, 3,
+                                 make_pseudonymizer())
+    assert read_csv(outfile) == read_csv(expected)
+    assert not os.path.exists(outfile + '.progress')
+    # Only the unfinished batches were fetched again, without re-listing
+    # the records.
+    assert len(redcap.requests) == 2
+
+
+def test_watermark_uses_server_clock(redcap, monkeypatch):
+    monkeypatch.setenv('REDCAP_TIMEZONE', 'UTC')
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    watermark = datetime.datetime.strptime(
+        fetch_raw_data.get_watermark(redcap.url, 'token'),
+        fetch_raw_data.WATERMARK_FORMAT)
+    overlap = fetch_raw_data.WATERMARK_OVERLAP
+    assert abs(now - overlap - watermark) < datetime.timedelta(seconds=5)
+    assert redcap.requests[-1]['content'] == 'version'
+
+
+def test_fetch_incremental_merges_changes(redcap, tmp_path, monkeypatch):
+    monkeypatch.setenv('REDCAP_TIMEZONE', 'UTC')
+    outfile = str(tmp_path / 'raw.csv')
+    delta = str(tmp_path / fetch_raw_data.DELTA_FILENAME)
+    with open(delta, 'w') as fout:
+        fout.write('stale')
+    fetch_raw_data.fetch_incremental(redcap.url, 'token', outfile,
+                                     make_pseudonymizer())
+    # The first sync is a full fetch, which makes the old delta stale.
+    assert not os.path.exists(delta)
+    with open(str(tmp_path / 'sync_state.json'), 'r') as fin:
+        watermark = json.load(fin)['last_sync']
+
+    redcap.rows[4][3] = 'edited'
+    redcap.rows.append(['11', 'event_1_arm_1', 'user11@example.org', 'new'])
+    redcap.modified = {'3': watermark, '11': watermark}
+    fetch_raw_data.fetch_incremental(redcap.url, 'token', outfile,
+                                     make_pseudonymizer())
+    rows = read_csv(outfile)
+    assert rows[3][3] == 'edited'
+    assert rows[-1][0] == '11' and len(rows) == 12
+    assert [row[0] for row in read_csv(delta)[1:]] == ['3', '11']
+    assert redcap.requests[-1]['dateRangeBegin'] == watermark
@@ -0,0 +1,162 @@
+import csv
+import os
+import socket
+import sqlite3
+
+import pytest
+
+from src.data import make_dataset
+from src.features import postal_index
+
+# GeoNames entries of the postal codes drawn for the generated export.
+GEONAMES = [('US', '12345'), ('CA', 'K1A'), ('GB', 'SW1A'), ('AU', '2000')]
+TABLES = ('users', 'feedback', 'dogs', 'dogs_adjusted')
+
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    """Point the build at a temporary data directory and postal index."""
+    for name, path in [('raw_filepath', 'raw.csv'),
+                       ('delta_filepath', 'delta.csv'),
+                       ('processed_filepath', 'processed.db'),
+                       ('metrics_filepath', 'metrics.json'),
+                       ('postal_cache_filepath', 'postal_cache.db')]:
+        monkeypatch.setattr(make_dataset, name, str(tmp_path / path))
+    dump = tmp_path / 'geonames.txt'
+    dump.write_text(''.join('%s\t%s\tPlace\n' %entry for entry in GEONAMES))
+    index_path = str(tmp_path / 'postal_index.db')
+    postal_index.build_index(str(dump), index_path)
+    monkeypatch.setattr(make_dataset.postal_index, 'load_index',
+                        lambda *args, **kwargs:
+                        postal_index.PostalIndex(index_path))
+    return tmp_path
+
+
+def write_rows(path, rows):
+    """Write rows to a CSV file."""
+    with open(path, 'w', newline='') as fout:
+        csv.writer(fout).writerows(rows)
+
+
+def read_tables(path, key=repr):
+    """Return the columns and the rows of every table, sorted by a key or
+    else in their stored order."""
+    conn = sqlite3.connect(path)
+    try:
+        tables = {}
+        for table in TABLES:
+            cursor = conn.execute('SELECT * FROM %s;' %table)
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+            tables[table] = (columns, sorted(rows, key=key) if key else rows)
+        return tables
+    finally:
+        conn.close()
+
+
+def test_incremental_update_matches_rebuild(dataset, export):
+    rows = export.make_rows(200, 60)
+    write_rows(make_dataset.raw_filepath, [export.header] + rows)
+    make_dataset.main()
+
+    # Edit stored rows, then add a record of a stored user and a new user.
+    changes = {}
+    for row in rows[::7]:
+        edited = export.make_row(row[make_dataset.USER_COLUMN], row[1],
+                                 record_id=row[0])
+        changes[(row[0], row[1])] = edited
+    for email in (rows[0][make_dataset.USER_COLUMN], 'new@example.org'):
+        row = export.make_row(email)
+        changes[(row[0], row[1])] = row
+    delta = list(changes.values())
+    merged = [changes.pop((row[0], row[1]), row) for row in rows]
+    merged.extend(changes.values())
+    write_rows(make_dataset.raw_filepath, [export.header] + merged)
+    write_rows(make_dataset.delta_filepath, [export.header] + delta)
+    make_dataset.main(incremental=True)
+    assert not os.path.exists(make_dataset.delta_filepath)
+    updated = read_tables(make_dataset.processed_filepath)
+
+    make_dataset.main()
+    rebuilt = read_tables(make_dataset.processed_filepath)
+    for table in TABLES:
+        assert updated[table] == rebuilt[table], table
+
+
+@pytest.mark.parametrize('user_batch_size', [1, 7, 1000])
+def test_streamed_build_matches_serial_build(dataset, export,
+                                             user_batch_size):
+    rows = export.make_rows(300, 80)
+    write_rows(make_dataset.raw_filepath, [export.header] + rows)
+    make_dataset.main()
+    built = read_tables(make_dataset.processed_filepath)
+    make_dataset.main(user_batch_size=user_batch_size)
+    # Users merged across batches are stored in another order.
+    streamed = read_tables(make_dataset.processed_filepath)
+    for table in TABLES:
+        assert streamed[table] == built[table], table
+
+def test_build_without_dump_stays_offline(dataset, export, monkeypatch):
+    connections = []
+
+    def connect(host, *args, **kwargs):
+        connections.append(host)
+        raise OSError('no network in this test')
+
+    monkeypatch.setattr(make_dataset.postal_index, 'load_index',
+                        lambda *args, **kwargs: None)
+    # Every connection starts by resolving its host.
+    monkeypatch.setattr(socket, 'getaddrinfo', connect)
+    rows = export.make_rows(50, 20)
+    write_rows(make_dataset.raw_filepath, [export.header] + rows)
+    make_dataset.main()
+    assert connections == []
+    conn = sqlite3.connect(make_dataset.processed_filepath)
+    try:
+        countries = {row[0] for row in conn.execute(
+            'SELECT country FROM users;')}
+    finally:
+        conn.close()
+    assert countries <= {postal_index.NOT_PROVIDED,
+                         postal_index.NOT_IDENTIFIED}
+
+
+def test_rebuild_parses_ages_again(dataset, export):
+    rows = export.make_rows(100, 30)
+    write_rows(make_dataset.raw_filepath, [export.header] + rows)
+    make_dataset.main()
+    built = read_tables(make_dataset.processed_filepath)
+    conn = sqlite3.connect(make_dataset.processed_filepath)
+    conn.execute("UPDATE age_cache SET months='1.00';")
+    conn.commit()
+    conn.close()
+    make_dataset.main()
+    assert read_tables(make_dataset.processed_filepath) == built
+
+
+def test_columnar_build_matches_row_build(dataset, export):
+    rows = export.make_rows(300, 80)
+    write_rows(make_dataset.raw_filepath, [export.header] + rows)
+    make_dataset.main()
+    built = read_tables(make_dataset.processed_filepath, key=None)
+    make_dataset.main(columnar=True)
+    columnar = read_tables(make_dataset.processed_filepath, key=None)
+    for table in TABLES:
+        assert columnar[table] == built[table], table
+
+
+@pytest.mark.parametrize('workers', [1, 2, 4])
+def test_sharded_build_matches_serial_build(dataset, export, workers):
+    rows = export.make_rows(300, 80)
+    write_rows(make_dataset.raw_filepath, [export.header] + rows)
+    make_dataset.main()
+    built = read_tables(make_dataset.processed_filepath, key=None)
+    make_dataset.main(workers=workers)
+    sharded = read_tables(make_dataset.processed_filepath, key=None)
+    for table in TABLES:
+        assert sharded[table] == built[table], table
+    # The postal columns were resolved, not just equally empty.
+    columns, users = sharded['users']
+    countries = {user[columns.index('country')] for user in users}
+    assert countries - {postal_index.NOT_PROVIDED,
+                        postal_index.NOT_IDENTIFIED}
@@ -0,0 +1,64 @@
+import sqlite3
+
+import pytest
+
+from src.utilities import parquet_tables
+
+pq = pytest.importorskip('pyarrow.parquet')
+
+
+@pytest.fixture
+def con():
+    """Return a database with a table of typed columns."""
+    con = sqlite3.connect(':memory:')
+    con.execute('CREATE TABLE dogs (record_id INTEGER, weight REAL, '
+                'dog_name TEXT);')
+    con.executemany('INSERT INTO dogs VALUES (?, ?, ?);',
+                    [(i, i / 2, 'dog %d' %i) for i in range(10)])
+    yield con
+    con.close()
+
+
+def export(con, directory, batch_size=3):
+    """Export the dogs table and return it read back with its row groups."""
+    assert parquet_tables.write_tables(con, str(directory), ['dogs'],
+                                       batch_size)
+    path = parquet_tables.get_path(str(directory), 'dogs')
+    return pq.read_table(path), pq.ParquetFile(path).num_row_groups
+
+
+def test_write_tables_streams_row_groups(con, tmp_path):
+    table, row_groups = export(con, tmp_path)
+    assert row_groups == 4
+    assert str(table.schema.field('record_id').type) == 'int64'
+    assert str(table.schema.field('weight').type) == 'double'
+    assert table.column('record_id').to_pylist() == list(range(10))
+    assert not list(tmp_path.glob('*.part'))
+
+
+@pytest.mark.parametrize('record_id', [1, 8])
+def test_write_tables_exports_mismatched_columns_as_text(con, tmp_path,
+                                                         record_id):
+    # In the first row group, or in one after others were written.
+    con.execute("UPDATE dogs SET weight='heavy' WHERE record_id=?;",
+                (record_id,))
+    table, row_groups = export(con, tmp_path)
+    assert row_groups == 4
+    assert str(table.schema.field('weight').type) == 'string'
+    weights = table.column('weight').to_pylist()
+    assert weights[record_id] == 'heavy'
+    assert weights[0] == '0.0'
+    assert str(table.schema.field('record_id').type) == 'int64'
+
+
+def test_write_tables_keeps_the_schema_of_empty_tables(con, tmp_path):
+    con.execute('DELETE FROM dogs;')
+    table, _ = export(con, tmp_path)
+    assert table.num_rows == 0
+    assert table.schema.names == ['record_id', 'weight', 'dog_name']
+
+
+def test_remove_tables(con, tmp_path):
+    export(con, tmp_path)
+    parquet_tables.remove_tables(str(tmp_path), ['dogs'])
+    assert not list(tmp_path.glob('*.parquet'))
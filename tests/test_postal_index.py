@@ -0,0 +1,184 @@
+import http.server
+import json
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from src.features import postal_index
+from src.features import postal_recovery
+
+# GeoNames entries of the test index.
+GEONAMES = [('US', '12345'), ('DE', '10115'), ('CA', 'K1A')]
+
+
+class FakeResolver(object):
+    """Answers lookups from a fixed table of codes."""
+
+    def __init__(self, countries):
+        self.countries = countries # country name by code, None if down
+        self.lookups = {}
+
+    def resolve(self, lookups):
+        self.lookups.update(lookups)
+        return {code: self.countries[code] for code in lookups
+                if code in self.countries}
+
+
+class FakePostalApi(object):
+    """A postal code API, zippopotam.us style, answering from memory."""
+
+    def __init__(self, countries):
+        self.countries = countries # country name by (country, code)
+        self.failures = {} # 503 responses left to send by (country, code)
+        self.delays = {} # seconds before answering, by country
+        self.requests = [] # (country, code) of every request received
+        self.active = 0 # requests being answered
+        self.peak = 0 # most requests answered at once
+        self.lock = threading.Lock()
+        self.url = None
+
+    def answer(self, country, code):
+        """Return the status and body answering a lookup."""
+        with self.lock:
+            self.requests.append((country, code))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            failures = self.failures.get((country, code), 0)
+            self.failures[(country, code)] = failures - 1
+        try:
+            time.sleep(self.delays.get(country, 0.02))
+            if failures > 0:
+                return 503, {}
+            name = self.countries.get((country, code))
+            if name is None:
+                return 404, {}
+            return 200, {'country': name, 'post code': code}
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def make_api_handler(api):
+    """Return a request handler class serving the postal code API."""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            country, code = self.path.strip('/').split('/')
+            status, data = api.answer(country, code)
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def postal_api(monkeypatch):
+    """Serve a fake postal code API for the duration of a test."""
+    monkeypatch.setattr(postal_index, 'RETRY_BACKOFF', 0)
+    api = FakePostalApi({('us', '12345'): 'United States',
+                         ('de', '12345'): 'Germany',
+                         ('mx', '12345'): 'Mexico'})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             make_api_handler(api))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    api.url = 'http://127.0.0.1:%d/' %server.server_port
+    yield api
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def index(tmp_path):
+    """Return a postal index of the test entries."""
+    dump = tmp_path / 'geonames.txt'
+    dump.write_text(''.join('%s\t%s\tPlace\n' %entry for entry in GEONAMES))
+    path = str(tmp_path / 'postal_index.db')
+    postal_index.build_index(str(dump), path)
+    return postal_index.PostalIndex(path)
+
+
+def translate(index, codes, resolver=None):
+    """Return the translation and confidence of each code."""
+    translator = postal_index.PostalTranslator(
+        index, resolver, recovery=postal_recovery.PostalRecovery(index))
+    result = translator.translate(pd.Series(codes)).set_index('zip_code')
+    return {code: (result.loc[code, 'translation'],
+                   result.loc[code, 'confidence']) for code in codes}
+
+
+def test_indexed_codes_are_not_looked_up(index):
+    resolver = FakeResolver({})
+    result = translate(index, ['12345', 'K1A 0B1'], resolver)
+    assert result['12345'] == ('United States', 1.0)
+    assert result['K1A 0B1'] == ('Canada', 1.0)
+    assert not resolver.lookups
+
+
+def test_well_formed_codes_are_looked_up_before_recovery(index):
+    resolver = FakeResolver({'12346': 'Germany'})
+    result = translate(index, ['12346'], resolver)
+    # Offline, the code would be recovered as its indexed US neighbor.
+    assert result['12346'] == ('Germany', 1.0)
+    assert '12346' in resolver.lookups
+
+
+@pytest.mark.parametrize('countries', [{}, {'12346': None}])
+def test_codes_unknown_online_are_recovered(index, countries):
+    result = translate(index, ['12346'], FakeResolver(countries))
+    country, confidence = result['12346']
+    assert country == 'United States'
+    assert confidence < 1
+
+
+def test_malformed_codes_are_recovered_offline(index):
+    resolver = FakeResolver({})
+    result = translate(index, ['D-10115', 'ZZ', ''], resolver)
+    assert result['D-10115'][0] == 'Germany'
+    assert result['ZZ'][0] == postal_index.NOT_IDENTIFIED
+    assert result[''][0] == postal_index.NOT_PROVIDED
+    # Codes without a candidate country cannot be looked up.
+    assert not any(resolver.lookups.values())
+
+
+def test_resolver_respects_host_limit(postal_api):
+    resolver = postal_index.PostalResolver(postal_api.url, workers=16,
+                                           host_limit=3)
+    lookups = {'%05d' %code: ['us'] for code in range(40)}
+    resolver.resolve(lookups)
+    assert len(postal_api.requests) == 40
+    assert 1 < postal_api.peak <= 3
+
+
+def test_resolver_retries_server_errors(postal_api):
+    postal_api.failures[('us', '12345')] = 2
+    postal_api.failures[('de', '10115')] = postal_index.RETRIES + 1
+    resolver = postal_index.PostalResolver(postal_api.url)
+    translations = resolver.resolve({'12345': ['us'], '10115': ['de']})
+    assert translations['12345'] == 'United States'
+    assert postal_api.requests.count(('us', '12345')) == 3
+    # Once the retries run out, the API did not answer.
+    assert translations['10115'] is None
+    assert (postal_api.requests.count(('de', '10115'))
+            == postal_index.RETRIES + 1)
+
+
+def test_resolver_prefers_first_candidate(postal_api):
+    # The later candidates answer first.
+    postal_api.delays = {'us': 0.2, 'de': 0.1, 'mx': 0}
+    resolver = postal_index.PostalResolver(postal_api.url)
+    assert resolver.resolve({'12345': ['us', 'de', 'mx']}) == {
+        '12345': 'United States'}
+    assert resolver.resolve({'12345': ['fr', 'de', 'mx']}) == {
+        '12345': 'Germany'}